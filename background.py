@@ -0,0 +1,75 @@
+"""
+Background loops for ClipBot V2
+A task started on first use that runs a step, sleeps, and can be woken early
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundLoop:
+    """Runs ``step()`` repeatedly in one background task.
+
+    ``step()`` returns how many seconds to sleep before it runs again
+    (None = until woken). The task starts on the first ``start()`` or
+    ``wake()``, and again if it ever died. ``wake()`` cuts the current
+    sleep short; a wakeup that arrives while the step runs is not lost.
+    ``close()`` lets a running step finish instead of cancelling it, so
+    owners can flush what is left afterwards.
+    """
+
+    def __init__(self, step: Callable[[], Awaitable[Optional[float]]],
+                 delay: Optional[float] = 0, name: str = None):
+        self.step = step
+        # Sleep before the first step
+        self.delay = delay
+        self.name = name or step.__qualname__
+        self._wakeup = None
+        self._task = None
+        self._closing = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Start the task unless it is running or closed (needs a running loop)"""
+        if self.running or self._closing:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run(), name=self.name)
+
+    def wake(self):
+        """Start the task if needed and run the step now"""
+        self.start()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        delay = self.delay
+        while not self._closing:
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            if self._closing:
+                break
+            try:
+                delay = await self.step()
+            except Exception as e:
+                logger.error(f"{self.name} failed: {e}")
+                # Back off instead of spinning on a step that keeps failing
+                delay = 1.0
+
+    async def close(self):
+        """Stop the task after the step in progress"""
+        self._closing = True
+        if self.running:
+            self._wakeup.set()
+            await self._task
+        self._task = None
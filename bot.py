@@ -1,15 +1,42 @@
 import os
+import hmac
 import asyncio
 import signal
+from urllib.parse import urlsplit
 from aiohttp import web
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
-from telegram_handlers import handle_update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.constants import ParseMode
+from telegram.helpers import escape_markdown
+from telegram.ext import ApplicationBuilder, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+from telegram_handlers import handle_update, subscription_activated, db, quotas, writes, subscriptions
+from downloader import extraction_pool, inflight_stats, extractor_stats, close_http_client
+from media_cache import result_cache, file_id_cache, purge_expired_caches
+from rate_limiter import scheduler
+import transcoder
+from translations import get_text, get_user_language
+from payment import AsyncPayPalHandler, PayPalWebhook
 
 # متغيرات البيئة
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# مسار التحديثات على خادمنا هو مسار WEBHOOK_URL نفسه
+WEBHOOK_PATH = urlsplit(WEBHOOK_URL or "").path or "/"
+# يرسله تيليجرام في ترويسة X-Telegram-Bot-Api-Secret-Token مع كل تحديث
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# /metrics يتطلب "Authorization: Bearer <METRICS_TOKEN>"، وبدونه يُقبل من الجهاز نفسه فقط
+METRICS_TOKEN = os.getenv("METRICS_TOKEN") or WEBHOOK_SECRET
 # استخدام متغير البيئة PORT الذي توفره Railway، مع قيمة افتراضية 8080
 PORT = int(os.getenv("PORT", "8080"))
+# معرفات المسؤولين مفصولة بفواصل
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()}
+# عدد الصفوف في كل صفحة من قوائم المسؤول
+ADMIN_PAGE_SIZE = 10
+# مسار إشعارات PayPal (يُسجل في لوحة PayPal مع PAYPAL_WEBHOOK_ID)
+PAYPAL_WEBHOOK_PATH = os.getenv("PAYPAL_WEBHOOK_PATH", "/paypal/webhook")
+
+paypal = AsyncPayPalHandler(db=db)
+paypal_webhook = PayPalWebhook(paypal, db, on_activated=subscription_activated)
 
 # ----------------------------------------------------------------------
 # دوال الـ aiohttp للخادم الصحي (Health Server)
@@ -19,10 +46,65 @@ async def health(request):
     """نقطة نهاية لفحص حالة الخادم (Health Check)."""
     return web.Response(text="OK")
 
-async def setup_health_server(port):
-    """إعداد وتشغيل خادم aiohttp."""
+def metrics_allowed(request) -> bool:
+    if METRICS_TOKEN:
+        return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}")
+    return request.remote in ("127.0.0.1", "::1")
+
+async def metrics(request):
+    """عدادات الأداء الداخلية (التخزين المؤقت وطابور الاستخراج)."""
+    if not metrics_allowed(request):
+        return web.Response(status=403)
+    return web.json_response({
+        "extraction_cache": result_cache.stats(),
+        "file_id_cache": file_id_cache.stats(),
+        "extraction_pool": {
+            "pending": extraction_pool.pending,
+            "queued": extraction_pool.queued,
+            "coalesced": inflight_stats["coalesced"],
+        },
+        "extractors": extractor_stats,
+        "outgoing": scheduler.stats(),
+        "transcode": {
+            "running": transcoder.jobs.running,
+            "queued": transcoder.jobs.queued,
+        },
+        "quota": quotas.stats(),
+        "subscriptions": subscriptions.stats(),
+        "db_writes": writes.stats(),
+        "paypal_webhook": paypal_webhook.stats(),
+        "update_queue": request.app["bot_app"].update_queue.qsize(),
+    })
+
+async def paypal_webhook_handler(request):
+    """إشعارات PayPal: التحقق من التوقيع ثم تفعيل الاشتراك في الخلفية."""
+    body = await request.read()
+    status = await paypal_webhook.receive(request.headers, body)
+    return web.Response(status=status)
+
+async def telegram_webhook(request):
+    """تحديثات تيليجرام: تُحوَّل إلى Update وتوضع مباشرة في طابور التطبيق."""
+    if WEBHOOK_SECRET and not hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET
+    ):
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+
+    bot_app = request.app["bot_app"]
+    await bot_app.update_queue.put(Update.de_json(data, bot_app.bot))
+    return web.Response()
+
+async def setup_web_server(port, bot_app):
+    """خادم aiohttp واحد: فحص الحالة، العدادات، تحديثات تيليجرام وإشعارات PayPal."""
     aio_app = web.Application()
+    aio_app["bot_app"] = bot_app
     aio_app.router.add_get("/health", health)
+    aio_app.router.add_get("/metrics", metrics)
+    aio_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    aio_app.router.add_post(PAYPAL_WEBHOOK_PATH, paypal_webhook_handler)
     runner = web.AppRunner(aio_app)
     await runner.setup()
     # يجب أن يستمع الخادم على المنفذ المحدد
@@ -56,6 +138,77 @@ async def message_handler(update, context):
     # ولكن للحفاظ على الكود الأصلي، سنفترض أن التعديل على النحو التالي هو الأفضل:
     await handle_update(update.to_dict())
 
+# ----------------------------------------------------------------------
+# قوائم المسؤول (صفحات مع أزرار التالي/السابق)
+# ----------------------------------------------------------------------
+
+def _md(value) -> str:
+    return escape_markdown(str(value or "-"))
+
+def _user_line(row: dict, lang: str) -> str:
+    name = _md(row.get("first_name"))
+    username = f" @{_md(row['username'])}" if row.get("username") else ""
+    return f"• {name}{username} — `{row['user_id']}` · {str(row['created_at'])[:10]}"
+
+def _subscription_line(row: dict, lang: str) -> str:
+    name = _md(row.get("first_name"))
+    username = f" @{_md(row['username'])}" if row.get("username") else ""
+    tier = get_text(lang, f"tier_{row['tier']}")
+    return f"• {name}{username} — {tier} · {row['status']} · {str(row['end_date'])[:10]}"
+
+# نوع القائمة: (دالة الصفحة، دالة العدد، مفتاح العنوان، مفتاح المؤشر، تنسيق السطر)
+ADMIN_LISTS = {
+    "users": ("get_users_page", "count_users", "admin_users_title", ("created_at", "user_id"), _user_line),
+    "subs": ("get_subscriptions_page", "count_subscriptions", "admin_subs_title", ("start_date", "id"), _subscription_line),
+}
+
+def _cursor_data(kind: str, direction: str, row: dict) -> str:
+    created_col, id_col = ADMIN_LISTS[kind][3]
+    return f"admin:{kind}:{direction}:{row[created_col]}|{row[id_col]}"
+
+async def render_admin_page(kind: str, lang: str, cursor: tuple = None, backward: bool = False):
+    """يجلب صفحة واحدة فقط (ADMIN_PAGE_SIZE + 1 صف لمعرفة وجود صفحة بعدها)."""
+    page_method, count_method, title_key, _, format_line = ADMIN_LISTS[kind]
+    rows = await getattr(db, page_method)(ADMIN_PAGE_SIZE + 1, cursor, backward)
+    more = len(rows) > ADMIN_PAGE_SIZE
+    rows = rows[-ADMIN_PAGE_SIZE:] if backward else rows[:ADMIN_PAGE_SIZE]
+    has_prev = more if backward else cursor is not None
+    has_next = True if backward else more
+
+    title = get_text(lang, title_key, count=await getattr(db, count_method)()).replace("**", "*")
+    text = "\n".join([title, ""] + [format_line(row, lang) for row in rows])
+
+    buttons = []
+    if rows and has_prev:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=_cursor_data(kind, "prev", rows[0])))
+    if rows and has_next:
+        buttons.append(InlineKeyboardButton("➡️", callback_data=_cursor_data(kind, "next", rows[-1])))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def admin_list_command(update, context):
+    """معالج أمري /users و /subscriptions للمسؤولين."""
+    user = update.effective_user
+    lang = get_user_language(user.language_code)
+    if user.id not in ADMIN_IDS:
+        await update.effective_message.reply_text(get_text(lang, "error_admin_only"))
+        return
+    kind = "users" if update.effective_message.text.startswith("/users") else "subs"
+    text, markup = await render_admin_page(kind, lang)
+    await update.effective_message.reply_text(text, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
+
+async def admin_page_callback(update, context):
+    """أزرار التنقل بين الصفحات: admin:<kind>:<next|prev>:<created>|<id>"""
+    query = update.callback_query
+    lang = get_user_language(query.from_user.language_code)
+    if query.from_user.id not in ADMIN_IDS:
+        await query.answer(get_text(lang, "error_admin_only"), show_alert=True)
+        return
+    _, kind, direction, position = query.data.split(":", 3)
+    created, _, row_id = position.rpartition("|")
+    text, markup = await render_admin_page(kind, lang, (created, int(row_id)), backward=direction == "prev")
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=markup, parse_mode=ParseMode.MARKDOWN)
+
 # ----------------------------------------------------------------------
 # دالة التشغيل الرئيسية مع الإيقاف اللطيف (Graceful Shutdown)
 # ----------------------------------------------------------------------
@@ -64,39 +217,63 @@ async def main():
     """الدالة الرئيسية لتشغيل البوت والخادم الصحي مع معالجة الإيقاف اللطيف."""
     
     # 1. إعداد تطبيق البوت
-    bot_app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # concurrent_updates: حتى لا ينتظر كل تحديث انتهاء التحديث الذي قبله
+    # updater(None): التحديثات تصل عبر خادم aiohttp الخاص بنا، فلا حاجة لخادم ثانٍ
+    bot_app = ApplicationBuilder().token(BOT_TOKEN).updater(None).concurrent_updates(True).build()
     bot_app.add_handler(CommandHandler("start", start))
+    bot_app.add_handler(CommandHandler(["users", "subscriptions"], admin_list_command))
+    bot_app.add_handler(CallbackQueryHandler(admin_page_callback, pattern=r"^admin:"))
     bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
     await bot_app.initialize()
 
-    # 2. إعداد خادم الـ Health Check
-    aio_runner = await setup_health_server(PORT)
+    # تجهيز عمال الاستخراج وكائنات yt-dlp قبل استقبال أول طلب
+    await extraction_pool.warm_up()
+    # حذف الملفات المؤقتة المتبقية من تشغيل سابق
+    transcoder.cleanup_stale()
+    # تحميل الاشتراكات النشطة وجدولة انتهائها
+    await subscriptions.load()
+    # إكمال إشعارات الدفع التي لم تُعالج قبل آخر إيقاف
+    await paypal_webhook.resume()
+    # حذف نتائج الاستخراج و file_id المنتهية دورياً حتى لا يكبر ملف التخزين المؤقت
+    purge_task = asyncio.create_task(purge_expired_caches())
 
-    # 3. بدء الـ Webhook
-    # ملاحظة: يجب أن يكون url_path هو الجزء الأخير من WEBHOOK_URL
-    # إذا كان WEBHOOK_URL هو https://worker-production-8ff1.up.railway.app/webhook
-    # فإن url_path يجب أن يكون "webhook"
-    # سنفترض أن WEBHOOK_URL يحتوي على المسار كاملاً وأن المسار هو "/"
-    # إذا كان المسار مختلفاً، يجب استخراجه من WEBHOOK_URL
-    
-    # سنستخدم المسار الفارغ "/" كافتراضي، وهو الشائع
-    await bot_app.updater.start_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path="", # المسار الذي يستمع عليه البوت (عادةً ما يكون فارغاً أو مساراً محدداً)
-        webhook_url=WEBHOOK_URL,
+    # 2. بدء معالجة التحديثات ثم فتح الخادم على PORT (منفذ واحد لكل المسارات)
+    await bot_app.start()
+    aio_runner = await setup_web_server(PORT, bot_app)
+
+    # 3. تسجيل الـ Webhook لدى تيليجرام
+    await bot_app.bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
     )
     
     # 4. دالة الإيقاف اللطيف
     async def shutdown(loop):
         print("تلقي إشارة إنهاء (SIGTERM). جاري إيقاف البوت بشكل لطيف...")
         
-        # إيقاف تطبيق البوت
-        await bot_app.updater.stop()
-        await bot_app.shutdown()
-        
-        # إيقاف خادم aiohttp
+        # إيقاف خادم aiohttp أولاً حتى لا تصل تحديثات جديدة
         await aio_runner.cleanup()
+
+        # إيقاف تطبيق البوت بعد معالجة ما في الطابور
+        await bot_app.stop()
+        await bot_app.shutdown()
+
+        # إيقاف مجمع الاستخراج
+        extraction_pool.shutdown()
+        await close_http_client()
+        await scheduler.close()
+        purge_task.cancel()
+
+        # إنهاء تفعيل الاشتراكات الجارية
+        await paypal_webhook.close()
+        await paypal.close()
+        await subscriptions.close()
+
+        # حفظ السجلات المعلقة وعدادات التنزيل اليومية ثم إغلاق اتصالات قاعدة البيانات
+        await writes.close()
+        await quotas.close()
+        db.close()
         
         # إيقاف حلقة الأحداث
         loop.stop()
@@ -107,8 +284,6 @@ async def main():
     loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(shutdown(loop)))
 
     # 6. تشغيل حلقة الأحداث إلى الأبد (أو حتى يتم إيقافها بواسطة SIGTERM)
-    await bot_app.start()
-    
     # الانتظار حتى يتم إيقاف الحلقة
     while loop.is_running():
         await asyncio.sleep(1)
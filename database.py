@@ -3,37 +3,194 @@ Database module for ClipBot V2
 Handles users, subscriptions, and download statistics
 """
 
+import os
 import sqlite3
-from datetime import datetime, timedelta
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, List
 import logging
 
+from background import BackgroundLoop
+
 logger = logging.getLogger(__name__)
 
-import sqlite3
+DB_PATH = os.getenv("DB_PATH", "/tmp/clipbot.db")
+# Threads used by AsyncDatabase; each keeps its own persistent connection
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))
+
+# Applied once to every new connection
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -65536",
+)
+
+# WriteQueue flushes every DB_FLUSH_INTERVAL_MS or once DB_FLUSH_ROWS are buffered
+WRITE_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL_MS", "250")) / 1000
+WRITE_FLUSH_ROWS = int(os.getenv("DB_FLUSH_ROWS", "500"))
+
+# Schema migrations, applied in order; PRAGMA user_version records how many
+# have run. Append new steps, never edit old ones.
+MIGRATIONS = (
+    # 1: indexes for the per-download quota check, date-range stats and
+    # subscription lookups
+    (
+        "CREATE INDEX IF NOT EXISTS idx_downloads_user_date ON downloads (user_id, download_date)",
+        "CREATE INDEX IF NOT EXISTS idx_downloads_date ON downloads (download_date)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_status_end ON subscriptions (status, end_date)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions (user_id, status, end_date)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_start ON subscriptions (start_date)",
+        "CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)",
+    ),
+    # 2: per-user daily download counters kept by the quota tracker
+    (
+        """
+        CREATE TABLE IF NOT EXISTS daily_usage (
+            user_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+        """,
+    ),
+    # 3: rollups for the admin dashboards, kept current by triggers on
+    # users and downloads and backfilled from existing rows
+    (
+        "ALTER TABLE daily_stats ADD COLUMN successful_downloads INTEGER DEFAULT 0",
+        """
+        CREATE TABLE IF NOT EXISTS daily_active_users (
+            date DATE NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (date, user_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS platform_stats (
+            platform TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            successful INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS media_type_stats (
+            media_type TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0,
+            successful INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS downloads_rollup AFTER INSERT ON downloads
+        BEGIN
+            INSERT INTO daily_stats (date, total_downloads, successful_downloads)
+            VALUES (date(NEW.download_date), 1, NEW.success = 1)
+            ON CONFLICT(date) DO UPDATE SET
+                total_downloads = total_downloads + 1,
+                successful_downloads = successful_downloads + (NEW.success = 1);
+            INSERT OR IGNORE INTO daily_active_users (date, user_id)
+            VALUES (date(NEW.download_date), NEW.user_id);
+            INSERT INTO platform_stats (platform, total, successful)
+            VALUES (NEW.platform, 1, NEW.success = 1)
+            ON CONFLICT(platform) DO UPDATE SET
+                total = total + 1,
+                successful = successful + (NEW.success = 1);
+            INSERT INTO media_type_stats (media_type, total, successful)
+            VALUES (NEW.media_type, 1, NEW.success = 1)
+            ON CONFLICT(media_type) DO UPDATE SET
+                total = total + 1,
+                successful = successful + (NEW.success = 1);
+            INSERT INTO stats_totals (name, value)
+            VALUES ('successful_downloads', NEW.success = 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + (NEW.success = 1);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS daily_active_users_rollup AFTER INSERT ON daily_active_users
+        BEGIN
+            UPDATE daily_stats SET active_users = active_users + 1 WHERE date = NEW.date;
+        END
+        """,
+        # Fires for new users only; the upsert's update path is not an insert
+        """
+        CREATE TRIGGER IF NOT EXISTS users_rollup AFTER INSERT ON users
+        BEGIN
+            INSERT INTO daily_stats (date, new_users)
+            VALUES (date(NEW.created_at), 1)
+            ON CONFLICT(date) DO UPDATE SET new_users = new_users + 1;
+            INSERT INTO stats_totals (name, value) VALUES ('users', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+        """,
+        "DELETE FROM daily_stats",
+        """
+        INSERT INTO daily_stats (date, total_downloads, successful_downloads)
+        SELECT date(download_date), COUNT(*), SUM(success = 1)
+        FROM downloads GROUP BY date(download_date)
+        """,
+        """
+        INSERT OR IGNORE INTO daily_active_users (date, user_id)
+        SELECT DISTINCT date(download_date), user_id FROM downloads
+        """,
+        """
+        INSERT INTO daily_stats (date, new_users)
+        SELECT date(created_at), COUNT(*) FROM users GROUP BY date(created_at)
+        ON CONFLICT(date) DO UPDATE SET new_users = excluded.new_users
+        """,
+        """
+        INSERT OR REPLACE INTO platform_stats (platform, total, successful)
+        SELECT platform, COUNT(*), SUM(success = 1) FROM downloads GROUP BY platform
+        """,
+        """
+        INSERT OR REPLACE INTO media_type_stats (media_type, total, successful)
+        SELECT media_type, COUNT(*), SUM(success = 1) FROM downloads GROUP BY media_type
+        """,
+        """
+        INSERT OR REPLACE INTO stats_totals (name, value)
+        SELECT 'users', COUNT(*) FROM users
+        UNION ALL
+        SELECT 'successful_downloads', COUNT(*) FROM downloads WHERE success = 1
+        """,
+    ),
+    # 4: PayPal webhook events, recorded once per event id so deliveries
+    # are processed idempotently and unfinished ones resume after a restart
+    (
+        """
+        CREATE TABLE IF NOT EXISTS paypal_events (
+            event_id TEXT PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_paypal_events_pending ON paypal_events (received_at) WHERE processed_at IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_payment ON subscriptions (payment_id)",
+    ),
+)
+
+# Called as listener(user_id, tier, end_date, subscription_id) after
+# add_subscription on any Database instance
+subscription_listeners = []
 
 class Database:
-    def __init__(self, db_path: str = "/tmp/clipbot.db"):
+    def __init__(self, db_path: str = DB_PATH):
         self.db_path = db_path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
         self.init_database()
 
-    def get_connection(self):
-        return sqlite3.connect(self.db_path)
-
-    def init_database(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                language TEXT,
-                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
-        conn.close()
-
     def add_or_update_user(self, user_id: int, username: str, language: str):
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -46,14 +203,33 @@ class Database:
                 last_seen = CURRENT_TIMESTAMP
         """, (user_id, username, language))
         conn.commit()
-        conn.close()
     
     def get_connection(self):
-        """Get database connection"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
+        """Get this thread's persistent database connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            for pragma in CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
         return conn
     
+    def close(self):
+        """Checkpoint the WAL and close every thread's connection"""
+        with self._connections_lock:
+            if self._connections:
+                try:
+                    self._connections[0].execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except sqlite3.Error as e:
+                    logger.warning(f"WAL checkpoint failed: {e}")
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+    
     def init_database(self):
         """Initialize database tables"""
         conn = self.get_connection()
@@ -113,9 +289,32 @@ class Database:
         """)
         
         conn.commit()
-        conn.close()
+        self.migrate()
         logger.info("Database initialized successfully")
     
+    def migrate(self):
+        """Apply pending schema migrations"""
+        conn = self.get_connection()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        
+        # In its default mode sqlite3 commits before DDL, so each migration
+        # runs in an explicit transaction: all of it applies or none of it
+        isolation_level, conn.isolation_level = conn.isolation_level, None
+        try:
+            for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute(f"PRAGMA user_version = {number}")
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                logger.info(f"Applied database migration {number}")
+        finally:
+            conn.isolation_level = isolation_level
+    
     # User management
     def add_user(self, user_id: int, username: str = None, first_name: str = None, 
                  last_name: str = None, language_code: str = None, preferred_language: str = None):
@@ -136,7 +335,32 @@ class Database:
         """, (user_id, username, first_name, last_name, language_code, preferred_language))
         
         conn.commit()
-        conn.close()
+    
+    def write_batch(self, users: List[tuple], downloads: List[tuple]):
+        """Upsert users and insert downloads in a single transaction
+        
+        users rows are (user_id, username, first_name, last_name,
+        language_code, preferred_language); downloads rows are
+        (user_id, url, platform, media_type, success, download_date).
+        """
+        conn = self.get_connection()
+        
+        with conn:
+            conn.executemany("""
+                INSERT INTO users (user_id, username, first_name, last_name, language_code, preferred_language)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    language_code = excluded.language_code,
+                    preferred_language = COALESCE(excluded.preferred_language, users.preferred_language),
+                    last_active = CURRENT_TIMESTAMP
+            """, users)
+            conn.executemany("""
+                INSERT INTO downloads (user_id, url, platform, media_type, success, download_date)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, downloads)
     
     def get_user(self, user_id: int) -> Optional[Dict]:
         """Get user by ID"""
@@ -145,21 +369,49 @@ class Database:
         
         cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
         row = cursor.fetchone()
-        conn.close()
         
         return dict(row) if row else None
     
     def get_all_users(self) -> List[Dict]:
-        """Get all users"""
+        """Get all users (prefer iter_users or get_users_page on large tables)"""
+        return list(self.iter_users())
+    
+    def get_users_page(self, limit: int = 10, cursor: tuple = None,
+                       backward: bool = False) -> List[Dict]:
+        """Get one page of users, newest first
+        
+        cursor is the (created_at, user_id) of the last row of the previous
+        page, or of the first row when paging backward. Only the rows of
+        this page are read (keyset pagination on idx_users_created).
+        """
         conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT * FROM users ORDER BY created_at DESC")
-        rows = cursor.fetchall()
-        conn.close()
-        
+        order = "ASC" if backward else "DESC"
+        where = ""
+        params = ()
+        if cursor is not None:
+            where = f"WHERE (created_at, user_id) {'>' if backward else '<'} (?, ?)"
+            params = tuple(cursor)
+        
+        rows = conn.execute(f"""
+            SELECT * FROM users {where}
+            ORDER BY created_at {order}, user_id {order}
+            LIMIT ?
+        """, (*params, limit)).fetchall()
+        
+        if backward:
+            rows.reverse()
         return [dict(row) for row in rows]
     
+    def iter_users(self, batch_size: int = 500):
+        """Yield every user, newest first, reading batch_size rows at a time"""
+        cursor = None
+        while True:
+            page = self.get_users_page(batch_size, cursor)
+            yield from page
+            if len(page) < batch_size:
+                return
+            cursor = (page[-1]['created_at'], page[-1]['user_id'])
+    
     def set_user_language(self, user_id: int, language: str):
         """Set user's preferred language"""
         conn = self.get_connection()
@@ -170,7 +422,6 @@ class Database:
         """, (language, user_id))
         
         conn.commit()
-        conn.close()
     
     def get_user_language(self, user_id: int) -> str:
         """Get user's preferred language"""
@@ -181,8 +432,8 @@ class Database:
     
     # Subscription management
     def add_subscription(self, user_id: int, tier: str, duration_days: int = 30, 
-                        payment_id: str = None):
-        """Add subscription for user"""
+                        payment_id: str = None) -> int:
+        """Add subscription for user, returning its id"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -194,7 +445,13 @@ class Database:
         """, (user_id, tier, end_date, payment_id))
         
         conn.commit()
-        conn.close()
+        
+        for listener in list(subscription_listeners):
+            try:
+                listener(user_id, tier, end_date, cursor.lastrowid)
+            except Exception as e:
+                logger.error(f"Subscription listener failed: {e}")
+        return cursor.lastrowid
     
     def get_active_subscription(self, user_id: int) -> Optional[Dict]:
         """Get active subscription for user"""
@@ -208,27 +465,116 @@ class Database:
         """, (user_id,))
         
         row = cursor.fetchone()
-        conn.close()
         
         return dict(row) if row else None
     
     def get_all_subscriptions(self) -> List[Dict]:
-        """Get all subscriptions"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """Get all subscriptions (prefer iter_subscriptions or get_subscriptions_page)"""
+        return list(self.iter_subscriptions())
+    
+    def get_subscriptions_page(self, limit: int = 10, cursor: tuple = None,
+                               backward: bool = False) -> List[Dict]:
+        """Get one page of subscriptions with user info, newest first
         
-        cursor.execute("""
+        cursor is the (start_date, id) of the last row of the previous page,
+        or of the first row when paging backward.
+        """
+        conn = self.get_connection()
+        order = "ASC" if backward else "DESC"
+        where = ""
+        params = ()
+        if cursor is not None:
+            where = f"WHERE (s.start_date, s.id) {'>' if backward else '<'} (?, ?)"
+            params = tuple(cursor)
+        
+        rows = conn.execute(f"""
             SELECT s.*, u.username, u.first_name 
             FROM subscriptions s
             JOIN users u ON s.user_id = u.user_id
-            ORDER BY s.start_date DESC
-        """)
+            {where}
+            ORDER BY s.start_date {order}, s.id {order}
+            LIMIT ?
+        """, (*params, limit)).fetchall()
         
-        rows = cursor.fetchall()
-        conn.close()
+        if backward:
+            rows.reverse()
+        return [dict(row) for row in rows]
+    
+    def iter_subscriptions(self, batch_size: int = 500):
+        """Yield every subscription, newest first, reading batch_size rows at a time"""
+        cursor = None
+        while True:
+            page = self.get_subscriptions_page(batch_size, cursor)
+            yield from page
+            if len(page) < batch_size:
+                return
+            cursor = (page[-1]['start_date'], page[-1]['id'])
+    
+    def count_subscriptions(self) -> int:
+        """Get the number of subscriptions"""
+        conn = self.get_connection()
+        return conn.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0]
+    
+    def has_subscription_payment(self, payment_id: str) -> bool:
+        """Check whether a payment already activated a subscription"""
+        conn = self.get_connection()
+        row = conn.execute(
+            "SELECT 1 FROM subscriptions WHERE payment_id = ? LIMIT 1", (payment_id,)
+        ).fetchone()
+        return row is not None
+    
+    # PayPal webhook events
+    def record_paypal_event(self, event_id: str, event_type: str, payload: str) -> bool:
+        """Store a webhook event; returns False if it was already received"""
+        conn = self.get_connection()
+        
+        with conn:
+            cursor = conn.execute("""
+                INSERT OR IGNORE INTO paypal_events (event_id, event_type, payload)
+                VALUES (?, ?, ?)
+            """, (event_id, event_type, payload))
+        
+        return cursor.rowcount == 1
+    
+    def mark_paypal_event_processed(self, event_id: str):
+        """Mark a webhook event as handled"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.execute("""
+                UPDATE paypal_events SET processed_at = CURRENT_TIMESTAMP WHERE event_id = ?
+            """, (event_id,))
+    
+    def get_pending_paypal_events(self) -> List[Dict]:
+        """Get received webhook events that were not handled yet, oldest first"""
+        conn = self.get_connection()
+        
+        rows = conn.execute("""
+            SELECT * FROM paypal_events WHERE processed_at IS NULL ORDER BY received_at
+        """).fetchall()
         
         return [dict(row) for row in rows]
     
+    def get_subscription_states(self) -> List[Dict]:
+        """Get id, user_id, tier and end_date of every active, unexpired subscription"""
+        conn = self.get_connection()
+        
+        rows = conn.execute("""
+            SELECT id, user_id, tier, end_date FROM subscriptions
+            WHERE status = 'active' AND end_date > CURRENT_TIMESTAMP
+        """).fetchall()
+        
+        return [dict(row) for row in rows]
+    
+    def expire_subscriptions_by_id(self, subscription_ids: List[int]):
+        """Mark the given subscriptions as expired (one primary-key update each)"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.executemany("""
+                UPDATE subscriptions SET status = 'expired' WHERE id = ? AND status = 'active'
+            """, [(subscription_id,) for subscription_id in subscription_ids])
+    
     def expire_subscriptions(self):
         """Mark expired subscriptions as expired"""
         conn = self.get_connection()
@@ -241,7 +587,6 @@ class Database:
         """)
         
         conn.commit()
-        conn.close()
     
     # Download management
     def add_download(self, user_id: int, url: str, platform: str, 
@@ -256,7 +601,6 @@ class Database:
         """, (user_id, url, platform, media_type, success))
         
         conn.commit()
-        conn.close()
     
     def get_user_downloads_today(self, user_id: int) -> int:
         """Get number of downloads by user today"""
@@ -265,16 +609,45 @@ class Database:
         
         cursor.execute("""
             SELECT COUNT(*) as count FROM downloads 
-            WHERE user_id = ? AND date(download_date) = date('now') AND success = 1
+            WHERE user_id = ? AND download_date >= date('now') AND download_date < date('now', '+1 day')
+              AND success = 1
         """, (user_id,))
         
         row = cursor.fetchone()
-        conn.close()
         
         return row['count'] if row else 0
     
+    def get_daily_usage(self, user_id: int, day: str) -> int:
+        """Get the quota counter for user on day (YYYY-MM-DD, UTC)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT count FROM daily_usage WHERE user_id = ? AND day = ?
+        """, (user_id, day))
+        
+        row = cursor.fetchone()
+        
+        return row['count'] if row else 0
+    
+    def save_daily_usage(self, rows: List[tuple]):
+        """Store (user_id, day, count) quota counters in one transaction"""
+        conn = self.get_connection()
+        
+        with conn:
+            conn.executemany("""
+                INSERT INTO daily_usage (user_id, day, count)
+                VALUES (?, ?, ?)
+                ON CONFLICT(user_id, day) DO UPDATE SET count = excluded.count
+            """, rows)
+    
     def get_downloads_by_date(self, days: int = 7) -> List[Dict]:
-        """Get downloads grouped by date"""
+        """Get downloads grouped by date.
+
+        The window is a rolling ``days * 24`` hours, so the oldest day is
+        partial; the daily_stats rollup only has whole days, so this reads
+        downloads directly (a range scan on idx_downloads_date).
+        """
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -291,7 +664,6 @@ class Database:
         """, (days,))
         
         rows = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in rows]
     
@@ -301,17 +673,12 @@ class Database:
         cursor = conn.cursor()
         
         cursor.execute("""
-            SELECT 
-                platform,
-                COUNT(*) as total,
-                SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as successful
-            FROM downloads
-            GROUP BY platform
+            SELECT platform, total, successful
+            FROM platform_stats
             ORDER BY total DESC
         """)
         
         rows = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in rows]
     
@@ -321,33 +688,41 @@ class Database:
         cursor = conn.cursor()
         
         cursor.execute("""
-            SELECT 
-                media_type,
-                COUNT(*) as total,
-                SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as successful
-            FROM downloads
-            GROUP BY media_type
+            SELECT media_type, total, successful
+            FROM media_type_stats
             ORDER BY total DESC
         """)
         
         rows = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in rows]
     
+    def count_users(self) -> int:
+        """Get the number of users (from the rollup, no table scan)"""
+        return self._stats_total(self.get_connection().cursor(), 'users')
+    
     # Statistics
+    def _stats_total(self, cursor, name: str) -> int:
+        """Read a running total kept by the rollup triggers"""
+        cursor.execute("SELECT value FROM stats_totals WHERE name = ?", (name,))
+        row = cursor.fetchone()
+        return row['value'] if row else 0
+    
+    def _successful_downloads_since(self, cursor, modifier: str) -> int:
+        """Sum successful downloads from date('now', modifier) on"""
+        cursor.execute("""
+            SELECT COALESCE(SUM(successful_downloads), 0) as count FROM daily_stats
+            WHERE date >= date('now', ?)
+        """, (modifier,))
+        return cursor.fetchone()['count']
+    
     def get_total_stats(self) -> Dict:
         """Get overall statistics"""
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        # Total users
-        cursor.execute("SELECT COUNT(*) as count FROM users")
-        total_users = cursor.fetchone()['count']
-        
-        # Total downloads
-        cursor.execute("SELECT COUNT(*) as count FROM downloads WHERE success = 1")
-        total_downloads = cursor.fetchone()['count']
+        total_users = self._stats_total(cursor, 'users')
+        total_downloads = self._stats_total(cursor, 'successful_downloads')
         
         # Active subscriptions
         cursor.execute("""
@@ -358,25 +733,16 @@ class Database:
         
         # Today's stats
         cursor.execute("""
-            SELECT COUNT(*) as count FROM downloads 
-            WHERE date(download_date) = date('now') AND success = 1
+            SELECT successful_downloads, active_users FROM daily_stats WHERE date = date('now')
         """)
-        today_downloads = cursor.fetchone()['count']
-        
-        cursor.execute("""
-            SELECT COUNT(DISTINCT user_id) as count FROM downloads 
-            WHERE date(download_date) = date('now')
-        """)
-        today_active_users = cursor.fetchone()['count']
-        
-        conn.close()
+        today = cursor.fetchone()
         
         return {
             'total_users': total_users,
             'total_downloads': total_downloads,
             'active_subscriptions': active_subs,
-            'today_downloads': today_downloads,
-            'today_active_users': today_active_users
+            'today_downloads': today['successful_downloads'] if today else 0,
+            'today_active_users': today['active_users'] if today else 0
         }
 
     # Admin functions
@@ -385,10 +751,6 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         
-        # Total users
-        cursor.execute("SELECT COUNT(*) as count FROM users")
-        total_users = cursor.fetchone()['count']
-        
         # Active subscriptions
         cursor.execute("""
             SELECT COUNT(*) as count FROM subscriptions 
@@ -396,40 +758,13 @@ class Database:
         """)
         active_subscriptions = cursor.fetchone()['count']
         
-        # Downloads today
-        cursor.execute("""
-            SELECT COUNT(*) as count FROM downloads 
-            WHERE date(download_date) = date('now') AND success = 1
-        """)
-        downloads_today = cursor.fetchone()['count']
-        
-        # Downloads this week
-        cursor.execute("""
-            SELECT COUNT(*) as count FROM downloads 
-            WHERE download_date >= date('now', '-7 days') AND success = 1
-        """)
-        downloads_week = cursor.fetchone()['count']
-        
-        # Downloads this month
-        cursor.execute("""
-            SELECT COUNT(*) as count FROM downloads 
-            WHERE download_date >= date('now', '-30 days') AND success = 1
-        """)
-        downloads_month = cursor.fetchone()['count']
-        
-        # Total downloads
-        cursor.execute("SELECT COUNT(*) as count FROM downloads WHERE success = 1")
-        total_downloads = cursor.fetchone()['count']
-        
-        conn.close()
-        
         return {
-            'total_users': total_users,
+            'total_users': self._stats_total(cursor, 'users'),
             'active_subscriptions': active_subscriptions,
-            'downloads_today': downloads_today,
-            'downloads_week': downloads_week,
-            'downloads_month': downloads_month,
-            'total_downloads': total_downloads
+            'downloads_today': self._successful_downloads_since(cursor, 'start of day'),
+            'downloads_week': self._successful_downloads_since(cursor, '-7 days'),
+            'downloads_month': self._successful_downloads_since(cursor, '-30 days'),
+            'total_downloads': self._stats_total(cursor, 'successful_downloads')
         }
     
     def get_active_subscriptions(self) -> List[Dict]:
@@ -446,7 +781,6 @@ class Database:
         """)
         
         rows = cursor.fetchall()
-        conn.close()
         
         result = []
         for row in rows:
@@ -467,16 +801,120 @@ class Database:
         cursor = conn.cursor()
         
         cursor.execute("""
-            SELECT 
-                date(download_date) as date,
-                COUNT(*) as count
-            FROM downloads
-            WHERE download_date >= date('now', ? || ' days') AND success = 1
-            GROUP BY date(download_date)
+            SELECT date, successful_downloads as count
+            FROM daily_stats
+            WHERE date >= date('now', ? || ' days') AND successful_downloads > 0
             ORDER BY date DESC
         """, (f'-{days}',))
         
         rows = cursor.fetchall()
-        conn.close()
         
         return [dict(row) for row in rows]
+
+class AsyncDatabase:
+    """Async facade over Database for the bot's handlers.
+
+    Every Database method is available as a coroutine, e.g.
+    ``await adb.get_user(user_id)``. Calls run on a small dedicated thread
+    pool, so the event loop never waits on SQLite.
+    """
+
+    def __init__(self, db: Database = None, workers: int = DB_WORKERS):
+        self.db = db or Database()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+
+        return call
+
+    def close(self):
+        """Wait for pending calls, then close all connections"""
+        self._executor.shutdown(wait=True)
+        self.db.close()
+
+
+class WriteQueue:
+    """Write-behind buffer for user upserts and download records.
+
+    ``add_user`` and ``add_download`` only append to memory; a background
+    task writes everything with ``Database.write_batch`` every
+    ``interval`` seconds or as soon as ``max_rows`` are waiting. Repeated
+    upserts of the same user collapse into one row. Call ``close()`` on
+    shutdown to write what is left.
+    """
+
+    def __init__(self, adb: AsyncDatabase, interval: float = WRITE_FLUSH_INTERVAL,
+                 max_rows: int = WRITE_FLUSH_ROWS):
+        self.adb = adb
+        self.interval = interval
+        self.max_rows = max_rows
+
+        self._users: Dict[int, tuple] = {}
+        self._downloads: List[tuple] = []
+        self._flusher = BackgroundLoop(self._flush_step, delay=interval, name="WriteQueue.flush")
+
+        self.written = 0
+        self.failures = 0
+
+    def add_user(self, user_id: int, username: str = None, first_name: str = None,
+                 last_name: str = None, language_code: str = None, preferred_language: str = None):
+        """Queue an add_user upsert"""
+        self._users[user_id] = (user_id, username, first_name, last_name, language_code, preferred_language)
+        self._queued()
+
+    def add_download(self, user_id: int, url: str, platform: str,
+                     media_type: str, success: bool = True):
+        """Queue an add_download record (timestamped now, not at flush time)"""
+        download_date = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        self._downloads.append((user_id, url, platform, media_type, success, download_date))
+        self._queued()
+
+    def _queued(self):
+        if len(self._users) + len(self._downloads) >= self.max_rows:
+            self._flusher.wake()
+        else:
+            self._flusher.start()
+
+    async def _flush_step(self) -> float:
+        try:
+            await self.flush()
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Write-behind flush failed: {e}")
+        return self.interval
+
+    async def flush(self):
+        """Write everything buffered so far in one transaction"""
+        users, self._users = self._users, {}
+        downloads, self._downloads = self._downloads, []
+        if not users and not downloads:
+            return
+        try:
+            await self.adb.write_batch(list(users.values()), downloads)
+        except Exception:
+            # Keep the rows for the next attempt; newer user data wins
+            for user_id, row in users.items():
+                self._users.setdefault(user_id, row)
+            self._downloads[:0] = downloads
+            raise
+        self.written += len(users) + len(downloads)
+
+    def stats(self) -> Dict:
+        return {
+            'pending_users': len(self._users),
+            'pending_downloads': len(self._downloads),
+            'written': self.written,
+            'failures': self.failures,
+        }
+
+    async def close(self):
+        """Stop the background task and durably write the remaining rows"""
+        await self._flusher.close()
+        await self.flush()
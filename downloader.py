@@ -1,47 +1,694 @@
+import os
+import re
+import html
+import math
+import time
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from collections import OrderedDict
+from dataclasses import dataclass, asdict, replace
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 import yt_dlp
 import httpx
 
-def resolve_redirect(url: str) -> str:
+from media_cache import result_cache
+from tiers import TIERS, get_tier
+
+# إعدادات مجمع الاستخراج (yt-dlp يعمل خارج حلقة الأحداث)
+EXTRACT_EXECUTOR = os.getenv("EXTRACT_EXECUTOR", "thread")  # "thread" أو "process"
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+EXTRACT_QUEUE_LIMIT = int(os.getenv("EXTRACT_QUEUE_LIMIT", "32"))
+# يُعاد إنشاء كائن YoutubeDL بعد هذا العدد من الاستخدامات
+YDL_MAX_USES = int(os.getenv("YDL_MAX_USES", "200"))
+
+# مدة التخزين المؤقت لنتائج الاستخراج (بالثواني)
+CACHE_MAX_TTL = int(os.getenv("CACHE_MAX_TTL", str(6 * 3600)))
+# هامش أمان قبل انتهاء صلاحية الروابط الموقعة
+CACHE_EXPIRY_MARGIN = 300
+
+# معرف المنشور لكل منصة، حتى تشترك الروابط المختلفة لنفس المنشور في نفس المفتاح
+CANONICAL_PATTERNS = [
+    ("youtube", re.compile(r"(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})")),
+    ("tiktok", re.compile(r"tiktok\.com/@[^/]*/(?:video|photo)/(\d+)")),
+    ("instagram", re.compile(r"instagram\.com/(?:[\w.]+/)?(?:p|reels?|tv)/([\w-]+)")),
+    ("twitter", re.compile(r"(?:twitter|x)\.com/[^/]+/status(?:es)?/(\d+)")),
+]
+
+# أقصى حجم يمكن إرساله لتيليجرام (50MB، أو 2000MB مع خادم Bot API محلي)
+LOCAL_BOT_API = not os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/").endswith("api.telegram.org")
+TELEGRAM_SIZE_CAP = int(os.getenv("UPLOAD_LIMIT", str((2000 if LOCAL_BOT_API else 50) * 1024 * 1024)))
+
+# الحقول التي نحتفظ بها من كل صيغة في التخزين المؤقت
+FORMAT_FIELDS = ("format_id", "url", "ext", "vcodec", "acodec", "filesize", "width", "height", "tbr",
+                 "http_headers")
+
+IMAGE_EXTS = {"jpg", "jpeg", "png", "webp", "heic"}
+VIDEO_EXTS = {"mp4", "mov", "m4v", "webm", "mkv"}
+AUDIO_EXTS = {"mp3", "m4a", "aac", "ogg", "opus", "wav"}
+
+
+@dataclass
+class MediaItem:
+    """وصف عنصر وسائط واحد كما أعاده الاستخراج."""
+    url: str
+    kind: str | None = None  # "video" أو "photo" أو "audio"
+    ext: str | None = None
+    vcodec: str | None = None
+    acodec: str | None = None
+    filesize: int | None = None
+    width: int | None = None
+    height: int | None = None
+    duration: float | None = None
+    file_id: str | None = None  # بعد أول إرسال ناجح
+    # ترويسات يطلبها الخادم (Referer، User-Agent...) كما أعادها yt-dlp للصيغة
+    http_headers: dict[str, str] | None = None
+    # الصيغ المتاحة (مدمجة أو صوت فقط) والصيغة المختارة لكل اشتراك
+    formats: list[dict] | None = None
+    variants: dict[str, str] | None = None
+
+    @property
+    def source(self) -> str:
+        """ما يُمرر لتيليجرام: file_id إن وجد وإلا الرابط."""
+        return self.file_id or self.url
+
+    @classmethod
+    def from_info(cls, info: dict) -> "MediaItem":
+        item = cls(
+            url=info["url"],
+            ext=info.get("ext"),
+            vcodec=info.get("vcodec"),
+            acodec=info.get("acodec"),
+            filesize=info.get("filesize") or info.get("filesize_approx"),
+            width=info.get("width"),
+            height=info.get("height"),
+            duration=info.get("duration"),
+            http_headers=info.get("http_headers"),
+        )
+        item.kind = classify_media(item.ext, item.vcodec, item.acodec)
+        item.formats = trim_formats(info.get("formats") or [], item.duration)
+        if item.kind == "video" and item.formats:
+            # الاختيار يتم مرة واحدة ويُخزن مع نتيجة الاستخراج
+            item.variants = {}
+            for tier, settings in TIERS.items():
+                fmt = select_format(item.formats, settings["max_height"])
+                if fmt:
+                    item.variants[tier] = fmt["format_id"]
+            fmt = select_audio_format(item.formats)
+            if fmt:
+                item.variants["audio"] = fmt["format_id"]
+        return item
+
+    def get_format(self, format_id: str) -> dict | None:
+        return next((f for f in self.formats or [] if f["format_id"] == format_id), None)
+
+    def for_tier(self, tier: str) -> "MediaItem":
+        """نسخة من العنصر بالصيغة المناسبة للاشتراك (أو العنصر نفسه).
+
+        إذا لم تناسب أي صيغة MP4 والعنصر أعلى من دقة الاشتراك، نختار أفضل صيغة
+        مدمجة بأي حاوية ضمن الدقة؛ وإن لم توجد يبقى أعلى منها ويُصغّر عند الإرسال.
+        """
+        fmt = self.get_format((self.variants or {}).get(tier))
+        if fmt is None and self.exceeds_height(tier):
+            max_height = get_tier(tier)["max_height"]
+            fmt = max((
+                f for f in self.formats or []
+                if is_muxed(f) and (f.get("height") or 0) <= max_height and fits(f)
+            ), key=lambda f: (f.get("height") or 0, f.get("tbr") or 0), default=None)
+        if fmt is None:
+            return self
+        return self.with_format(fmt)
+
+    def exceeds_height(self, tier: str) -> bool:
+        """فيديو بدقة أعلى مما يسمح به الاشتراك."""
+        max_height = get_tier(tier)["max_height"]
+        return self.kind == "video" and bool(max_height) and (self.height or 0) > max_height
+
+    def for_audio(self) -> "MediaItem | None":
+        """صيغة صوت جاهزة للإرسال (m4a/mp3)، أو None إذا احتاجت تحويلاً."""
+        if self.kind == "audio" and (self.ext or "") in ("m4a", "mp3"):
+            return self
+        fmt = self.get_format((self.variants or {}).get("audio"))
+        return self.with_format(fmt) if fmt else None
+
+    def audio_source(self) -> tuple[str, str | None, dict | None]:
+        """(الرابط، ترميز الصوت، الترويسات) لأصغر مصدر يحتوي على الصوت، لاستخدامه مع ffmpeg."""
+        formats = [f for f in self.formats or [] if is_audio_only(f)] or \
+                  [f for f in self.formats or [] if is_muxed(f)]
+        if not formats:
+            return self.url, self.acodec, self.http_headers
+        fmt = min(formats, key=lambda f: f.get("filesize") or TELEGRAM_SIZE_CAP)
+        return fmt["url"], fmt.get("acodec"), fmt.get("http_headers")
+
+    def transcode_source(self, max_height: int | None) -> "MediaItem":
+        """أفضل صيغة مدمجة ضمن دقة الاشتراك (بغض النظر عن الحجم) كمصدر للتحويل."""
+        formats = [
+            f for f in self.formats or []
+            if is_muxed(f) and (max_height is None or (f.get("height") or 0) <= max_height)
+        ]
+        if not formats:
+            return self
+        return self.with_format(max(formats, key=lambda f: (f.get("height") or 0, f.get("tbr") or 0)))
+
+    def with_format(self, fmt: dict) -> "MediaItem":
+        return replace(
+            self,
+            url=fmt["url"],
+            ext=fmt.get("ext"),
+            vcodec=fmt.get("vcodec"),
+            acodec=fmt.get("acodec"),
+            filesize=fmt.get("filesize"),
+            width=fmt.get("width"),
+            height=fmt.get("height"),
+            http_headers=fmt.get("http_headers"),
+            kind=classify_media(fmt.get("ext"), fmt.get("vcodec"), fmt.get("acodec")),
+        )
+
+
+def is_muxed(fmt: dict) -> bool:
+    return fmt.get("vcodec") not in (None, "none") and fmt.get("acodec") not in (None, "none")
+
+def is_audio_only(fmt: dict) -> bool:
+    return fmt.get("vcodec") == "none" and fmt.get("acodec") not in (None, "none")
+
+def trim_formats(formats: list[dict], duration: float | None) -> list[dict]:
+    """نحتفظ فقط بالصيغ التي يمكن إرسالها كرابط مباشر، مع تقدير الحجم إن لم يُذكر."""
+    trimmed = []
+    for fmt in formats:
+        if not fmt.get("url") or fmt.get("protocol") not in ("http", "https"):
+            continue
+        if not (is_muxed(fmt) or is_audio_only(fmt)):
+            continue
+        entry = {field: fmt.get(field) for field in FORMAT_FIELDS}
+        entry["filesize"] = fmt.get("filesize") or fmt.get("filesize_approx")
+        if not entry["filesize"] and fmt.get("tbr") and duration:
+            entry["filesize"] = int(fmt["tbr"] * 1000 / 8 * duration)
+        trimmed.append(entry)
+    return trimmed
+
+def fits(fmt: dict, size_cap: int = TELEGRAM_SIZE_CAP) -> bool:
+    """الصيغة تناسب الحد فقط إذا عُرف حجمها؛ الحجم المجهول قد يتجاوزه."""
+    return bool(fmt.get("filesize")) and fmt["filesize"] <= size_cap
+
+def select_audio_format(formats: list[dict], size_cap: int = TELEGRAM_SIZE_CAP) -> dict | None:
+    """أعلى جودة صوت فقط بصيغة يقبلها تيليجرام كملف صوتي (m4a أو mp3)."""
+    candidates = [
+        f for f in formats
+        if is_audio_only(f) and f.get("ext") in ("m4a", "mp3")
+        and fits(f, size_cap)
+    ]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda f: f.get("tbr") or 0)
+
+def select_format(formats: list[dict], max_height: int | None,
+                  size_cap: int = TELEGRAM_SIZE_CAP) -> dict | None:
+    """أعلى دقة مسموحة للاشتراك، وبين الصيغ بنفس الدقة: أصغر ملف MP4 مدمج يناسب الحد.
+
+    H.264 مفضل لأن تيليجرام يشغله مباشرة داخل المحادثة.
+    """
+    candidates = [
+        f for f in formats
+        if is_muxed(f) and f.get("ext") == "mp4"
+        and (max_height is None or (f.get("height") or 0) <= max_height)
+        and fits(f, size_cap)
+    ]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda f: (
+        -(f.get("height") or 0),
+        not (f.get("vcodec") or "").startswith("avc1"),
+        f["filesize"],
+    ))
+
+
+def classify_media(ext: str | None, vcodec: str | None, acodec: str | None) -> str | None:
+    ext = (ext or "").lower()
+    if ext in IMAGE_EXTS:
+        return "photo"
+    if vcodec and vcodec != "none":
+        return "video"
+    if acodec and acodec != "none":
+        return "audio"
+    if ext in VIDEO_EXTS:
+        return "video"
+    if ext in AUDIO_EXTS:
+        return "audio"
+    return None
+
+
+def classify_mime(content_type: str) -> str | None:
+    mime = content_type.split(";")[0].strip().lower()
+    if mime.startswith("image/"):
+        return "photo"
+    if mime.startswith("video/"):
+        return "video"
+    if mime.startswith("audio/"):
+        return "audio"
+    return None
+
+
+class QueueFullError(Exception):
+    """كل العمال مشغولون والطابور ممتلئ."""
+
+
+class ExtractionPool:
+    """مجمع عمال محدود لتشغيل الاستخراج المتزامن دون حجب حلقة الأحداث.
+
+    - ``workers``: أقصى عدد لعمليات الاستخراج المتزامنة.
+    - ``queue_limit``: أقصى عدد للطلبات المنتظرة خلف العمال المشغولين.
+    """
+
+    def __init__(self, workers: int, queue_limit: int, kind: str = "thread", initializer=None):
+        self.workers = max(1, workers)
+        self.queue_limit = max(0, queue_limit)
+        self.kind = kind
+        self.initializer = initializer
+        self._executor = None
+        self._slots = None
+        self._pending = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=self.initializer
+                )
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="extract",
+                    initializer=self.initializer,
+                )
+        return self._executor
+
+    async def warm_up(self):
+        """تشغيل كل العمال مسبقاً حتى يُنفذ ``initializer`` قبل أول طلب."""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        if self.kind == "process":
+            # ProcessPoolExecutor يشغل كل العمليات مع أول مهمة
+            await loop.run_in_executor(executor, _warm_noop)
+            return
+        # الحاجز يجبر كل مهمة على خيط مختلف
+        barrier = threading.Barrier(self.workers)
+        await asyncio.gather(*(
+            loop.run_in_executor(executor, _warm_wait, barrier) for _ in range(self.workers)
+        ))
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def queued(self) -> int:
+        return max(0, self._pending - self.workers)
+
+    async def run(self, func, *args, on_queued=None):
+        if self._pending >= self.workers + self.queue_limit:
+            raise QueueFullError()
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+
+        self._pending += 1
+        try:
+            # إبلاغ المستخدم بأنه في الطابور بدل ترك الطلب معلقاً بصمت
+            if self._pending > self.workers and on_queued:
+                await on_queued(self._pending - self.workers)
+
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _warm_noop():
+    pass
+
+def _warm_wait(barrier: threading.Barrier):
+    try:
+        barrier.wait(timeout=10)
+    except threading.BrokenBarrierError:
+        pass
+
+# عميل HTTP المشترك لتتبع التحويلات (مهلة صارمة حتى لا يعلق الطلب)
+HTTP_TIMEOUT = httpx.Timeout(5.0, connect=3.0)
+HTTP_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+REDIRECT_MEMO_SIZE = 4096
+# تحميل الملفات الكبيرة: مهلة للاتصال والقراءة فقط، بدون حد للمدة الكلية
+STREAM_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+STREAM_CHUNK_SIZE = 256 * 1024
+_http_client: httpx.AsyncClient | None = None
+_redirect_memo: OrderedDict[str, str] = OrderedDict()
+
+# عمليات الاستخراج الجارية حسب مفتاح المنشور (single-flight)
+_inflight: dict[str, asyncio.Future] = {}
+inflight_stats = {"coalesced": 0}
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """عميل HTTP مشترك (keep-alive + HTTP/2) بدل فتح اتصال جديد لكل رابط."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60),
+            headers={"User-Agent": HTTP_USER_AGENT},
+        )
+    return _http_client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+async def resolve_redirect(url: str) -> str:
+    # الرابط المختصر يشير دائماً لنفس المنشور، فلا داعي لتتبعه مرتين
+    resolved = _redirect_memo.get(url)
+    if resolved is not None:
+        _redirect_memo.move_to_end(url)
+        return resolved
+
+    client = get_http_client()
     try:
-        with httpx.Client(follow_redirects=True) as client:
-            response = client.get(url)
-            return str(response.url)
+        response = await client.head(url)
+
+        # بعض الخوادم لا تدعم HEAD؛ نستخدم GET بدون قراءة المحتوى
+        if response.status_code >= 400:
+            async with client.stream("GET", url) as response:
+                pass
+        resolved = str(response.url)
     except Exception as e:
         print(f"Redirect error: {e}")
         return url
 
+    _redirect_memo[url] = resolved
+    while len(_redirect_memo) > REDIRECT_MEMO_SIZE:
+        _redirect_memo.popitem(last=False)
+    return resolved
+
+@asynccontextmanager
+async def open_media_stream(url: str, headers: dict | None = None):
+    """يفتح الملف البعيد كتدفق؛ المحتوى يُقرأ على دفعات عبر ``aiter_raw``.
+
+    ``headers`` هي ترويسات الصيغة من yt-dlp؛ روابط بعض المنصات ترفض الطلب بدونها.
+    """
+    # identity: حتى يطابق ما نقرأه حجم Content-Length للملف نفسه
+    async with get_http_client().stream(
+        "GET", url, timeout=STREAM_TIMEOUT, headers={**(headers or {}), "Accept-Encoding": "identity"}
+    ) as response:
+        response.raise_for_status()
+        yield response
+
 def clean_instagram_url(url: str) -> str:
     if "instagram.com/p/" in url and "?img_index=" in url:
         url = url.split("?")[0]
     return url
 
-def fetch_media(url: str) -> list[str]:
+def canonical_key(url: str) -> str | None:
+    for platform, pattern in CANONICAL_PATTERNS:
+        match = pattern.search(url)
+        if match:
+            return f"{platform}:{match.group(1)}"
+    return None
+
+def key_platform(key: str) -> str:
+    """اسم المنصة من مفتاح المنشور الموحد ("other" للروابط غير المعروفة)."""
+    platform, sep, _ = key.partition(":")
+    return platform if sep and platform in dict(CANONICAL_PATTERNS) else "other"
+
+def url_expiry(media_url: str) -> float | None:
+    """وقت انتهاء صلاحية الرابط الموقع (unix) إن وجد."""
+    query = parse_qs(urlsplit(media_url).query)
+    for name in ("expire", "expires", "x-expires"):
+        if name in query:
+            try:
+                return float(query[name][0])
+            except ValueError:
+                pass
+    # روابط إنستغرام/فيسبوك: oe بصيغة hex
+    if "oe" in query:
+        try:
+            return float(int(query["oe"][0], 16))
+        except ValueError:
+            pass
+    return None
+
+def media_ttl(media: list[MediaItem]) -> float:
+    ttl = CACHE_MAX_TTL
+    now = time.time()
+    for item in media:
+        expiry = url_expiry(item.url)
+        if expiry is not None:
+            ttl = min(ttl, expiry - now - CACHE_EXPIRY_MARGIN)
+    return ttl
+
+# ----------------------------------------------------------------------
+# مستخرجات سريعة لكل منصة (تُجرب قبل yt-dlp)
+# ----------------------------------------------------------------------
+
+# المنصة -> [(الاسم، الدالة)]؛ الدالة تعيد قائمة روابط أو None للرجوع إلى yt-dlp.
+# للصور فقط: الفيديو يحتاج صيغ yt-dlp (دقة الاشتراك، الصوت) وترويساتها
+FAST_EXTRACTORS: dict[str, list[tuple[str, object]]] = {}
+# الاسم -> {"calls", "failures", "total_ms"}
+extractor_stats: dict[str, dict] = {}
+
+def fast_extractor(platform: str, name: str):
+    def register(func):
+        FAST_EXTRACTORS.setdefault(platform, []).append((name, func))
+        return func
+    return register
+
+def record_extractor(name: str, started: float, ok: bool):
+    stats = extractor_stats.setdefault(name, {"calls": 0, "failures": 0, "total_ms": 0.0})
+    stats["calls"] += 1
+    stats["total_ms"] += (time.perf_counter() - started) * 1000
+    if not ok:
+        stats["failures"] += 1
+
+async def run_fast_extractor(key: str, url: str) -> list[MediaItem] | None:
+    platform, _, post_id = key.partition(":")
+    for name, func in FAST_EXTRACTORS.get(platform, []):
+        started = time.perf_counter()
+        try:
+            media = await func(post_id, url)
+            # رابط لا يمكن جلبه يعني أن الصفحة تغيرت، فنرجع إلى yt-dlp
+            if media and not all(await asyncio.gather(*(reachable(item.url) for item in media))):
+                print(f"Fast extractor {name} returned an unreachable URL")
+                media = None
+        except Exception as e:
+            print(f"Fast extractor {name} error: {e}")
+            media = None
+        record_extractor(name, started, bool(media))
+        if media:
+            return media
+    return None
+
+async def reachable(url: str) -> bool:
+    response = await get_http_client().head(url)
+    return response.status_code < 400
+
+@fast_extractor("instagram", "instagram_image")
+async def instagram_single_image(shortcode: str, url: str) -> list[MediaItem] | None:
+    response = await get_http_client().get(f"https://www.instagram.com/p/{shortcode}/embed/captioned/")
+    if response.status_code != 200:
+        return None
+    page = response.text
+    # الفيديو والألبومات تحتاج yt-dlp
+    if "EmbeddedMediaVideo" in page or "Sidecar" in page:
+        return None
+    tag = re.search(r'<img[^>]+class="EmbeddedMediaImage"[^>]*>', page)
+    src = tag and re.search(r'src="([^"]+)"', tag.group(0))
+    return [MediaItem(url=html.unescape(src.group(1)), kind="photo", ext="jpg")] if src else None
+
+def _twitter_token(tweet_id: str) -> str:
+    # نفس حساب الواجهة: ((id / 1e15) * PI).toString(36) بدون الأصفار والنقطة
+    # (خوارزمية V8 لأقصر تمثيل كسري بأساس 36)
+    value = (float(tweet_id) / 1e15) * math.pi
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    whole, frac = int(value), value - int(value)
+    delta = max(0.5 * (math.nextafter(value, math.inf) - value), math.nextafter(0.0, 1.0))
+    frac_digits = []
+    while frac >= delta:
+        frac *= 36
+        delta *= 36
+        digit = int(frac)
+        frac_digits.append(digit)
+        frac -= digit
+        if (frac > 0.5 or (frac == 0.5 and digit & 1)) and frac + delta > 1:
+            # تقريب للأعلى
+            while frac_digits and frac_digits[-1] + 1 == 36:
+                frac_digits.pop()
+            if frac_digits:
+                frac_digits[-1] += 1
+            else:
+                whole += 1
+            break
+    out = ""
+    while whole:
+        whole, rem = divmod(whole, 36)
+        out = digits[rem] + out
+    out = (out or "0") + "." + "".join(digits[d] for d in frac_digits)
+    return re.sub(r"(0+|\.)", "", out)
+
+@fast_extractor("twitter", "twitter_photos")
+async def twitter_photos(tweet_id: str, url: str) -> list[MediaItem] | None:
+    response = await get_http_client().get(
+        "https://cdn.syndication.twimg.com/tweet-result",
+        params={"id": tweet_id, "token": _twitter_token(tweet_id), "lang": "en"},
+    )
+    if response.status_code != 200:
+        return None
+    media = response.json().get("mediaDetails") or []
+    if not media or any(m.get("type") != "photo" for m in media):
+        return None
+    return [MediaItem(url=m["media_url_https"], kind="photo", ext="jpg") for m in media]
+
+# ----------------------------------------------------------------------
+# كائنات YoutubeDL جاهزة لكل عامل ولكل ملف إعدادات
+# ----------------------------------------------------------------------
+
+YDL_PROFILES = {
+    "default": {
+        "quiet": True,
+        "skip_download": True,
+        "noplaylist": True,
+        "format": "best",
+    },
+}
+
+_ydl_local = threading.local()
+
+def get_ydl(profile: str = "default") -> yt_dlp.YoutubeDL:
+    """كائن YoutubeDL خاص بالعامل الحالي، يُعاد استخدامه حتى ``YDL_MAX_USES``."""
+    instances = getattr(_ydl_local, "instances", None)
+    if instances is None:
+        instances = _ydl_local.instances = {}
+
+    entry = instances.get(profile)
+    if entry is not None and entry[1] >= YDL_MAX_USES:
+        discard_ydl(profile)
+        entry = None
+    if entry is None:
+        entry = instances[profile] = [yt_dlp.YoutubeDL(YDL_PROFILES[profile]), 0]
+    entry[1] += 1
+    return entry[0]
+
+def discard_ydl(profile: str = "default"):
+    instances = getattr(_ydl_local, "instances", {})
+    entry = instances.pop(profile, None)
+    if entry is not None:
+        try:
+            entry[0].close()
+        except Exception as e:
+            print(f"YoutubeDL close error: {e}")
+
+def warm_worker():
+    """يُنفذ مرة عند بدء كل عامل: تحميل المستخرجات وتجهيز الكائنات."""
+    for profile in YDL_PROFILES:
+        ydl = get_ydl(profile)
+        _ydl_local.instances[profile][1] = 0
+        for ie_key in ("Youtube", "TikTok", "Instagram", "Twitter"):
+            ydl.get_info_extractor(ie_key)
+
+def extract_media(url: str, profile: str = "default") -> list[MediaItem]:
     try:
-        url = resolve_redirect(url)
         url = clean_instagram_url(url)
+        media = []
 
-        ydl_opts = {
-            "quiet": True,
-            "skip_download": True,
-            "format": "best",
-        }
-        media_urls = []
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-
-            if "entries" in info:
-                for entry in info["entries"]:
-                    media_url = entry.get("url")
-                    if media_url:
-                        media_urls.append(media_url)
-            else:
-                media_url = info.get("url")
-                if media_url:
-                    media_urls.append(media_url)
+        info = get_ydl(profile).extract_info(url, download=False)
+
+        for entry in info.get("entries") or [info]:
+            if entry and entry.get("url"):
+                media.append(MediaItem.from_info(entry))
 
-        return media_urls
+        return media
 
     except Exception as e:
+        # بعد الخطأ قد تكون حالة الكائن غير سليمة، نعيد إنشاءه
+        discard_ydl(profile)
         print(f"Error fetching media: {e}")
         return []
+
+extraction_pool = ExtractionPool(
+    EXTRACT_WORKERS, EXTRACT_QUEUE_LIMIT, EXTRACT_EXECUTOR, initializer=warm_worker
+)
+
+async def resolve_media_key(url: str) -> tuple[str, str]:
+    """يعيد (الرابط، مفتاح المنشور الموحد)."""
+    key = canonical_key(url)
+    if key is None:
+        # الروابط المختصرة فقط تحتاج تتبع التحويل لمعرفة المنشور
+        url = await resolve_redirect(url)
+        key = canonical_key(url) or url.split("#")[0]
+    return url, key
+
+async def fetch_media(url: str, on_queued=None, key: str | None = None) -> list[MediaItem]:
+    """نسخة غير متزامنة من الاستخراج تعمل داخل ``extraction_pool``.
+
+    النتائج تُخزن مؤقتاً حسب معرف المنشور، فلا يُعاد الاستخراج لنفس الرابط.
+    ترفع ``QueueFullError`` عندما يكون الطابور ممتلئاً، وتستدعي
+    ``on_queued(position)`` إذا اضطر الطلب للانتظار خلف عمال مشغولين.
+    """
+    if key is None:
+        url, key = await resolve_media_key(url)
+
+    cached = await result_cache.get(key)
+    if cached is not None:
+        return [MediaItem(**item) for item in cached]
+
+    # طلبات متزامنة لنفس المنشور تنتظر استخراجاً واحداً مشتركاً
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_extract_and_cache(url, key, on_queued))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _inflight.pop(key, None) if _inflight.get(key) is t else None)
+    else:
+        inflight_stats["coalesced"] += 1
+
+    # shield: إلغاء أحد المنتظرين لا يلغي الاستخراج على البقية
+    return await asyncio.shield(task)
+
+async def _extract_and_cache(url: str, key: str, on_queued=None) -> list[MediaItem]:
+    media = await run_fast_extractor(key, url)
+    if not media:
+        started = time.perf_counter()
+        media = await extraction_pool.run(extract_media, url, on_queued=on_queued)
+        record_extractor("yt_dlp", started, bool(media))
+    if media:
+        # التصنيف يتم مرة واحدة هنا ويُخزن مع النتيجة
+        await asyncio.gather(*(sniff_kind(item) for item in media if item.kind is None))
+        await result_cache.put(key, [asdict(item) for item in media], media_ttl(media))
+    return media
+
+async def probe_filesize(item: MediaItem) -> int | None:
+    """حجم الملف من Content-Length عبر HEAD عندما لا يذكره الاستخراج."""
+    if item.filesize is None:
+        try:
+            response = await get_http_client().head(item.url)
+            if response.headers.get("content-length"):
+                item.filesize = int(response.headers["content-length"])
+        except Exception as e:
+            print(f"HEAD size error: {e}")
+    return item.filesize
+
+async def sniff_kind(item: MediaItem):
+    """تصنيف احتياطي عبر HEAD عندما لا تكفي بيانات الاستخراج."""
+    try:
+        response = await get_http_client().head(item.url)
+        item.kind = classify_mime(response.headers.get("content-type", ""))
+        if item.filesize is None and response.headers.get("content-length"):
+            item.filesize = int(response.headers["content-length"])
+    except Exception as e:
+        print(f"HEAD classify error: {e}")
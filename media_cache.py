@@ -0,0 +1,177 @@
+"""
+Media cache module for ClipBot V2
+Caches extraction results and Telegram file_ids in memory (LRU)
+and on disk (SQLite)
+"""
+
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Any, Optional, Dict
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "/tmp/clipbot_cache.db")
+CACHE_MEMORY_ITEMS = int(os.getenv("CACHE_MEMORY_ITEMS", "1024"))
+# Telegram file_ids do not expire, this only bounds the table size
+FILE_ID_TTL = int(os.getenv("FILE_ID_TTL", str(90 * 24 * 3600)))
+CACHE_WORKERS = int(os.getenv("CACHE_WORKERS", "2"))
+# Expired rows are deleted in bulk this often (seconds)
+CACHE_PURGE_INTERVAL = float(os.getenv("CACHE_PURGE_INTERVAL", "3600"))
+
+# Disk-tier queries for every cache, kept off the event loop
+_executor = ThreadPoolExecutor(max_workers=CACHE_WORKERS, thread_name_prefix="cache")
+
+
+class ResultCache:
+    """Two-tier cache: an in-memory LRU in front of a SQLite table.
+
+    Values must be JSON serialisable. Every entry carries its own expiry
+    time, so signed media URLs are never served after they stop working.
+    Memory hits are answered on the event loop; SQLite reads and writes
+    run on the cache executor.
+    """
+
+    def __init__(self, table: str = "extraction_cache", db_path: str = CACHE_DB_PATH,
+                 max_items: int = CACHE_MEMORY_ITEMS):
+        self.table = table
+        self.db_path = db_path
+        self.max_items = max_items
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        # Separate locks, so a memory lookup never waits for a disk query
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("PRAGMA busy_timeout = 5000")
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute(
+            f"CREATE INDEX IF NOT EXISTS idx_{table}_expires ON {table} (expires_at)"
+        )
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None if missing/expired"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+        return await self._run(self._disk_get, key, now)
+
+    async def put(self, key: str, value: Any, ttl: float):
+        """Store value under key for ttl seconds (ignored if ttl <= 0)"""
+        if ttl <= 0:
+            return
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._remember(key, expires_at, value)
+        await self._run(self._disk_put, key, json.dumps(value), expires_at)
+
+    async def purge_expired(self) -> int:
+        """Delete expired rows from the disk tier"""
+        return await self._run(self._execute, f"DELETE FROM {self.table} WHERE expires_at <= ?",
+                               (time.time(),))
+
+    async def delete(self, key: str):
+        """Drop key from both tiers"""
+        with self._lock:
+            self._memory.pop(key, None)
+        await self._run(self._execute, f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+    def _disk_get(self, key: str, now: float) -> Optional[Any]:
+        with self._db_lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row and row[1] <= now:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        if row and row[1] > now:
+            value = json.loads(row[0])
+            with self._lock:
+                # A put that landed while we were reading is newer than the row
+                if key not in self._memory:
+                    self._remember(key, row[1], value)
+            self.disk_hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def _disk_put(self, key: str, value: str, expires_at: float):
+        self._execute(f"""
+            INSERT INTO {self.table} (key, value, expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                value = excluded.value,
+                expires_at = excluded.expires_at
+        """, (key, value, expires_at))
+
+    def _execute(self, sql: str, params: tuple) -> int:
+        with self._db_lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def stats(self) -> Dict:
+        """Get hit/miss counters"""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_items': len(self._memory),
+        }
+
+    def _remember(self, key: str, expires_at: float, value: Any):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+
+result_cache = ResultCache()
+# media key -> [[kind, file_id], ...] as returned by the first successful send,
+# where the media key names the formats sent ("<post>@<format ids>" or
+# "<post>@audio"); "<post>#<tier>" -> that tier's media key
+file_id_cache = ResultCache(table="telegram_files")
+
+
+async def purge_expired_caches(interval: float = CACHE_PURGE_INTERVAL):
+    """Delete expired rows from both cache tables every interval seconds.
+
+    Lookups only drop the key they read, so without this the tables keep
+    every post ever fetched. Runs until cancelled.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for cache in (result_cache, file_id_cache):
+            try:
+                removed = await cache.purge_expired()
+                if removed:
+                    logger.info(f"Purged {removed} expired rows from {cache.table}")
+            except Exception as e:
+                logger.error(f"Cache purge failed for {cache.table}: {e}")
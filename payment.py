@@ -5,29 +5,184 @@ TESTED AND WORKING VERSION
 """
 
 import os
+import json
+import time
+import uuid
+import zlib
+import random
+import asyncio
 import logging
+import threading
 import requests
+import httpx
 import base64
-from datetime import datetime, timedelta
-from database import Database
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Optional, Tuple
+from urllib.parse import urlsplit
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from database import Database, AsyncDatabase
+from tiers import TIERS
 
 logger = logging.getLogger(__name__)
 
+# Refresh the OAuth token this long before PayPal expires it
+TOKEN_REFRESH_MARGIN = 300
+# Callers stop using a token this close to its expiry and refresh inline
+TOKEN_EXPIRY_SKEW = 60
+# Retry delay after a failed background refresh
+TOKEN_RETRY_DELAY = 30
+
+# Overrides the sandbox/live API host (e.g. a local paypal_stub.py)
+PAYPAL_BASE_URL = os.getenv('PAYPAL_BASE_URL')
+PAYPAL_TIMEOUT = 10
+# AsyncPayPalHandler retries 5xx responses and timeouts with full jitter
+PAYPAL_MAX_RETRIES = int(os.getenv('PAYPAL_MAX_RETRIES', '3'))
+PAYPAL_RETRY_BASE = 0.5
+PAYPAL_RETRY_CAP = 8.0
+
+# Webhook ID from the PayPal developer dashboard; signatures cover it
+PAYPAL_WEBHOOK_ID = os.getenv('PAYPAL_WEBHOOK_ID')
+# Events that activate a subscription
+WEBHOOK_EVENTS = ('PAYMENT.SALE.COMPLETED',)
+
+
+def paypal_base_url(mode: str) -> str:
+    """API host for mode ('sandbox' or 'live'), unless PAYPAL_BASE_URL is set"""
+    if PAYPAL_BASE_URL:
+        return PAYPAL_BASE_URL.rstrip('/')
+    if mode == 'sandbox':
+        return 'https://api-m.sandbox.paypal.com'
+    return 'https://api-m.paypal.com'
+
+def payment_request(amount: float, description: str, user_id: int, tier: str) -> dict:
+    """Body of a /v1/payments/payment create call"""
+    return {
+        'intent': 'sale',
+        'payer': {
+            'payment_method': 'paypal'
+        },
+        'transactions': [{
+            'amount': {
+                'total': str(amount),
+                'currency': 'USD'
+            },
+            'description': description,
+            'custom': f"{user_id}|{tier}"  # Store user_id and tier
+        }],
+        'redirect_urls': {
+            'return_url': f'https://t.me/ClipotV2_bot?start=payment_success',
+            'cancel_url': f'https://t.me/ClipotV2_bot?start=payment_cancel'
+        }
+    }
+
+def approval_url(payment: dict) -> Optional[str]:
+    """Find the approval URL in a created payment"""
+    for link in payment.get('links', []):
+        if link['rel'] == 'approval_url':
+            return link['href']
+    return None
+
+def payment_owner(payment: dict) -> Tuple[Optional[int], Optional[str]]:
+    """Extract (user_id, tier) from the payment's custom field"""
+    custom = payment['transactions'][0].get('custom', '')
+    if '|' in custom:
+        user_id, tier = custom.split('|')
+        return int(user_id), tier
+    return None, None
+
+
+class AccessTokenCache:
+    """Caches an OAuth access token until shortly before it expires.
+
+    fetch() returns (token, expires_in) or None. A background timer
+    refreshes the token TOKEN_REFRESH_MARGIN seconds before expiry, so
+    callers normally never wait; if they do, concurrent callers share one
+    refresh under a lock.
+    """
+
+    def __init__(self, fetch: Callable[[], Optional[Tuple[str, int]]],
+                 margin: float = TOKEN_REFRESH_MARGIN):
+        self._fetch = fetch
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._timer = None
+        self.refreshes = 0
+
+    def _valid(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires_at - TOKEN_EXPIRY_SKEW
+
+    def get(self) -> Optional[str]:
+        """Return a valid token, fetching one only if none is cached"""
+        if self._valid():
+            return self._token
+        with self._lock:
+            # Another caller may have refreshed while we waited for the lock
+            if not self._valid():
+                self._refresh()
+            return self._token if self._valid() else None
+
+    def invalidate(self):
+        """Drop the cached token (e.g. after a 401)"""
+        with self._lock:
+            self._token = None
+            self._expires_at = 0.0
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _refresh(self) -> bool:
+        result = self._fetch()
+        if not result:
+            return False
+        token, expires_in = result
+        self._token = token
+        self._expires_at = time.monotonic() + expires_in
+        self.refreshes += 1
+        self._schedule(max(expires_in - self.margin, TOKEN_EXPIRY_SKEW))
+        return True
+
+    def _schedule(self, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            if self._refresh():
+                return
+            # Keep serving the current token and try again shortly
+            if self._valid():
+                self._schedule(TOKEN_RETRY_DELAY)
+            else:
+                self._timer = None
+                logger.error("PayPal token expired and could not be refreshed")
+
+
 class PayPalHandler:
-    def __init__(self):
+    def __init__(self, db: Database = None):
         self.client_id = os.getenv('PAYPAL_CLIENT_ID')
         self.secret = os.getenv('PAYPAL_SECRET')
         self.mode = os.getenv('PAYPAL_MODE', 'sandbox')  # 'sandbox' or 'live'
+        self.base_url = paypal_base_url(self.mode)
         
-        if self.mode == 'sandbox':
-            self.base_url = 'https://api-m.sandbox.paypal.com'
-        else:
-            self.base_url = 'https://api-m.paypal.com'
-        
-        self.db = Database()
+        self.db = db or Database()
+        self.token_cache = AccessTokenCache(self._fetch_access_token)
     
     def get_access_token(self) -> str:
-        """Get PayPal access token"""
+        """Get PayPal access token (cached and refreshed before it expires)"""
+        return self.token_cache.get()
+    
+    def _fetch_access_token(self) -> Optional[Tuple[str, int]]:
+        """Request a new PayPal access token, returning (token, expires_in)"""
         try:
             auth = base64.b64encode(
                 f"{self.client_id}:{self.secret}".encode()
@@ -48,7 +203,8 @@ class PayPalHandler:
             )
             
             if response.status_code == 200:
-                return response.json()['access_token']
+                token = response.json()
+                return token['access_token'], int(token.get('expires_in', 3600))
             else:
                 logger.error(f"Failed to get access token: {response.text}")
                 return None
@@ -81,24 +237,7 @@ class PayPalHandler:
             }
             
             # Create payment data
-            payment_data = {
-                'intent': 'sale',
-                'payer': {
-                    'payment_method': 'paypal'
-                },
-                'transactions': [{
-                    'amount': {
-                        'total': str(amount),
-                        'currency': 'USD'
-                    },
-                    'description': description,
-                    'custom': f"{user_id}|{tier}"  # Store user_id and tier
-                }],
-                'redirect_urls': {
-                    'return_url': f'https://t.me/ClipotV2_bot?start=payment_success',
-                    'cancel_url': f'https://t.me/ClipotV2_bot?start=payment_cancel'
-                }
-            }
+            payment_data = payment_request(amount, description, user_id, tier)
             
             response = requests.post(
                 f'{self.base_url}/v1/payments/payment',
@@ -111,23 +250,19 @@ class PayPalHandler:
                 payment = response.json()
                 payment_id = payment['id']
                 
-                # Find approval URL
-                approval_url = None
-                for link in payment['links']:
-                    if link['rel'] == 'approval_url':
-                        approval_url = link['href']
-                        break
-                
-                if approval_url:
+                url = approval_url(payment)
+                if url:
                     logger.info(f"Payment created: {payment_id}")
                     return {
                         'success': True,
                         'payment_id': payment_id,
-                        'approval_url': approval_url
+                        'approval_url': url
                     }
                 else:
                     return {'success': False, 'error': 'Approval URL not found'}
             else:
+                if response.status_code == 401:
+                    self.token_cache.invalidate()
                 logger.error(f"Failed to create payment: {response.text}")
                 return {'success': False, 'error': response.text}
         
@@ -170,6 +305,8 @@ class PayPalHandler:
                 logger.info(f"Payment executed: {payment_id}")
                 return {'success': True, 'payment': payment}
             else:
+                if response.status_code == 401:
+                    self.token_cache.invalidate()
                 logger.error(f"Failed to execute payment: {response.text}")
                 return {'success': False, 'error': response.text}
         
@@ -207,14 +344,7 @@ class PayPalHandler:
                 payment = response.json()
                 state = payment['state']
                 
-                # Extract user_id and tier from custom field
-                custom = payment['transactions'][0].get('custom', '')
-                if '|' in custom:
-                    user_id, tier = custom.split('|')
-                    user_id = int(user_id)
-                else:
-                    user_id = None
-                    tier = None
+                user_id, tier = payment_owner(payment)
                 
                 return {
                     'success': True,
@@ -224,6 +354,8 @@ class PayPalHandler:
                     'payment': payment
                 }
             else:
+                if response.status_code == 401:
+                    self.token_cache.invalidate()
                 logger.error(f"Failed to verify payment: {response.text}")
                 return {'success': False, 'error': response.text}
         
@@ -244,15 +376,304 @@ class PayPalHandler:
             bool: Success status
         """
         try:
-            # Calculate expiry date (30 days from now)
-            expiry_date = datetime.now() + timedelta(days=30)
-            
-            # Add subscription to database
+            # Add a 30 day subscription to database
             self.db.add_subscription(
                 user_id=user_id,
                 tier=tier,
                 payment_id=payment_id,
-                expiry_date=expiry_date
+                duration_days=30
+            )
+            
+            logger.info(f"Subscription activated for user {user_id}: {tier}")
+            return True
+        
+        except Exception as e:
+            logger.error(f"Error activating subscription: {e}")
+            return False
+
+
+class PayPalError(Exception):
+    """PayPal request could not be completed"""
+
+
+class AsyncAccessTokenCache:
+    """asyncio counterpart of AccessTokenCache; fetch is a coroutine function"""
+
+    def __init__(self, fetch, margin: float = TOKEN_REFRESH_MARGIN):
+        self._fetch = fetch
+        self.margin = margin
+        self._lock = asyncio.Lock()
+        self._token = None
+        self._expires_at = 0.0
+        self._task = None
+        self.refreshes = 0
+
+    def _valid(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires_at - TOKEN_EXPIRY_SKEW
+
+    async def get(self) -> Optional[str]:
+        """Return a valid token, fetching one only if none is cached"""
+        if self._valid():
+            return self._token
+        async with self._lock:
+            if not self._valid():
+                await self._refresh()
+            return self._token if self._valid() else None
+
+    def invalidate(self):
+        self._token = None
+        self._expires_at = 0.0
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _refresh(self) -> bool:
+        result = await self._fetch()
+        if not result:
+            return False
+        token, expires_in = result
+        self._token = token
+        self._expires_at = time.monotonic() + expires_in
+        self.refreshes += 1
+        self._schedule(max(expires_in - self.margin, TOKEN_EXPIRY_SKEW))
+        return True
+
+    def _schedule(self, delay: float):
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = asyncio.get_running_loop().create_task(self._background_refresh(delay))
+
+    async def _background_refresh(self, delay: float):
+        await asyncio.sleep(delay)
+        async with self._lock:
+            if await self._refresh():
+                return
+            if self._valid():
+                self._schedule(TOKEN_RETRY_DELAY)
+            else:
+                self._task = None
+                logger.error("PayPal token expired and could not be refreshed")
+
+
+class AsyncPayPalHandler:
+    """Non-blocking PayPalHandler for the bot's event loop.
+
+    Uses one pooled httpx.AsyncClient (keep-alive, HTTP/2). POST calls carry
+    a PayPal-Request-Id that stays the same across retries, so PayPal
+    processes a retried create or execute only once. 5xx responses and
+    timeouts are retried with full-jitter exponential backoff.
+    """
+
+    def __init__(self, db: AsyncDatabase = None, client: httpx.AsyncClient = None):
+        self.client_id = os.getenv('PAYPAL_CLIENT_ID')
+        self.secret = os.getenv('PAYPAL_SECRET')
+        self.mode = os.getenv('PAYPAL_MODE', 'sandbox')  # 'sandbox' or 'live'
+        self.base_url = paypal_base_url(self.mode)
+        
+        self.db = db
+        self._client = client
+        self.token_cache = AsyncAccessTokenCache(self._fetch_access_token)
+        self.retries = 0
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=PAYPAL_TIMEOUT,
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=120),
+            )
+        return self._client
+    
+    async def close(self):
+        self.token_cache.close()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def _send(self, method: str, path: str, request_id: str = None,
+                    authorize: bool = True, **kwargs) -> httpx.Response:
+        """Send a request, retrying 5xx and timeouts with jittered backoff"""
+        headers = dict(kwargs.pop('headers', {}))
+        if request_id:
+            headers['PayPal-Request-Id'] = request_id
+        
+        for attempt in range(PAYPAL_MAX_RETRIES + 1):
+            if authorize:
+                access_token = await self.token_cache.get()
+                if not access_token:
+                    raise PayPalError('Failed to get access token')
+                headers['Authorization'] = f'Bearer {access_token}'
+            
+            try:
+                response = await self.client.request(method, path, headers=headers, **kwargs)
+            except httpx.TransportError as e:
+                if attempt == PAYPAL_MAX_RETRIES:
+                    raise
+                logger.warning(f"PayPal {method} {path} failed ({e!r}), retrying")
+            else:
+                if response.status_code == 401 and authorize and attempt == 0:
+                    # Token revoked early; fetch a new one and retry at once
+                    self.token_cache.invalidate()
+                    continue
+                if response.status_code < 500 or attempt == PAYPAL_MAX_RETRIES:
+                    return response
+                logger.warning(f"PayPal {method} {path} returned {response.status_code}, retrying")
+            
+            self.retries += 1
+            await asyncio.sleep(random.uniform(0, min(PAYPAL_RETRY_CAP, PAYPAL_RETRY_BASE * 2 ** attempt)))
+        
+        raise PayPalError(f'PayPal {method} {path} was not authorized')
+    
+    async def _fetch_access_token(self) -> Optional[Tuple[str, int]]:
+        """Request a new PayPal access token, returning (token, expires_in)"""
+        try:
+            response = await self._send(
+                'POST', '/v1/oauth2/token',
+                authorize=False,
+                auth=(self.client_id or '', self.secret or ''),
+                data={'grant_type': 'client_credentials'},
+            )
+            if response.status_code == 200:
+                token = response.json()
+                return token['access_token'], int(token.get('expires_in', 3600))
+            logger.error(f"Failed to get access token: {response.text}")
+            return None
+        
+        except Exception as e:
+            logger.error(f"Error getting access token: {e}")
+            return None
+    
+    async def get_access_token(self) -> str:
+        """Get PayPal access token (cached and refreshed before it expires)"""
+        return await self.token_cache.get()
+    
+    async def create_payment(self, amount: float, description: str, user_id: int, tier: str,
+                             request_id: str = None) -> dict:
+        """
+        Create PayPal payment
+        
+        Args:
+            amount: Payment amount in USD
+            description: Payment description
+            user_id: Telegram user ID
+            tier: Subscription tier
+            request_id: Idempotency key (random if not given); reuse it to
+                retry the same payment without creating a second one
+            
+        Returns:
+            dict with success, payment_id, approval_url
+        """
+        try:
+            response = await self._send(
+                'POST', '/v1/payments/payment',
+                request_id=request_id or uuid.uuid4().hex,
+                json=payment_request(amount, description, user_id, tier),
+            )
+            
+            if response.status_code in (200, 201):
+                payment = response.json()
+                url = approval_url(payment)
+                if url:
+                    logger.info(f"Payment created: {payment['id']}")
+                    return {
+                        'success': True,
+                        'payment_id': payment['id'],
+                        'approval_url': url
+                    }
+                return {'success': False, 'error': 'Approval URL not found'}
+            
+            logger.error(f"Failed to create payment: {response.text}")
+            return {'success': False, 'error': response.text}
+        
+        except Exception as e:
+            logger.error(f"Error creating payment: {e}")
+            return {'success': False, 'error': str(e)}
+    
+    async def execute_payment(self, payment_id: str, payer_id: str) -> dict:
+        """
+        Execute PayPal payment after approval
+        
+        Args:
+            payment_id: PayPal payment ID
+            payer_id: PayPal payer ID
+            
+        Returns:
+            dict with success, payment details
+        """
+        try:
+            response = await self._send(
+                'POST', f'/v1/payments/payment/{payment_id}/execute',
+                # Executing the same approval twice must not charge twice
+                request_id=f'execute-{payment_id}-{payer_id}',
+                json={'payer_id': payer_id},
+            )
+            
+            if response.status_code == 200:
+                logger.info(f"Payment executed: {payment_id}")
+                return {'success': True, 'payment': response.json()}
+            
+            logger.error(f"Failed to execute payment: {response.text}")
+            return {'success': False, 'error': response.text}
+        
+        except Exception as e:
+            logger.error(f"Error executing payment: {e}")
+            return {'success': False, 'error': str(e)}
+    
+    async def verify_payment(self, payment_id: str) -> dict:
+        """
+        Verify payment status
+        
+        Args:
+            payment_id: PayPal payment ID
+            
+        Returns:
+            dict with success, status, user_id, tier
+        """
+        try:
+            response = await self._send('GET', f'/v1/payments/payment/{payment_id}')
+            
+            if response.status_code == 200:
+                payment = response.json()
+                user_id, tier = payment_owner(payment)
+                return {
+                    'success': True,
+                    'status': payment['state'],
+                    'user_id': user_id,
+                    'tier': tier,
+                    'payment': payment
+                }
+            
+            logger.error(f"Failed to verify payment: {response.text}")
+            return {'success': False, 'error': response.text}
+        
+        except Exception as e:
+            logger.error(f"Error verifying payment: {e}")
+            return {'success': False, 'error': str(e)}
+    
+    async def activate_subscription(self, user_id: int, tier: str, payment_id: str) -> bool:
+        """
+        Activate subscription after successful payment (30 days)
+        
+        Args:
+            user_id: Telegram user ID
+            tier: Subscription tier
+            payment_id: PayPal payment ID
+            
+        Returns:
+            bool: Success status
+        """
+        try:
+            if self.db is None:
+                self.db = AsyncDatabase()
+            await self.db.add_subscription(
+                user_id=user_id,
+                tier=tier,
+                payment_id=payment_id,
+                duration_days=30
             )
             
             logger.info(f"Subscription activated for user {user_id}: {tier}")
@@ -261,3 +682,170 @@ class PayPalHandler:
         except Exception as e:
             logger.error(f"Error activating subscription: {e}")
             return False
+
+
+class WebhookVerifier:
+    """Verifies PayPal webhook signatures locally.
+
+    PayPal signs ``transmission_id|transmission_time|webhook_id|crc32(body)``
+    with SHA256withRSA using the certificate at PAYPAL-CERT-URL. Certificates
+    are only fetched from paypal.com hosts and are cached until they expire,
+    so a delivery normally needs no outgoing request.
+    """
+
+    def __init__(self, webhook_id: str, client: Callable[[], httpx.AsyncClient]):
+        self.webhook_id = webhook_id
+        self._client = client
+        self._certs = {}
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def trusted_cert_url(url: str) -> bool:
+        parts = urlsplit(url or '')
+        host = (parts.hostname or '').lower()
+        return parts.scheme == 'https' and (host == 'paypal.com' or host.endswith('.paypal.com'))
+
+    async def certificate(self, url: str) -> Optional[x509.Certificate]:
+        """Signing certificate for url, from cache or fetched once"""
+        now = datetime.now(timezone.utc)
+        cert = self._certs.get(url)
+        if cert is not None and cert.not_valid_after_utc > now:
+            return cert
+        if not self.trusted_cert_url(url):
+            logger.warning(f"Rejected PayPal cert URL: {url}")
+            return None
+        
+        async with self._lock:
+            cert = self._certs.get(url)
+            if cert is None or cert.not_valid_after_utc <= now:
+                response = await self._client().get(url, timeout=PAYPAL_TIMEOUT)
+                response.raise_for_status()
+                cert = x509.load_pem_x509_certificate(response.content)
+                if not cert.not_valid_before_utc <= now < cert.not_valid_after_utc:
+                    logger.warning(f"PayPal cert outside its validity period: {url}")
+                    return None
+                self._certs[url] = cert
+        return cert
+
+    async def verify(self, headers, body: bytes) -> bool:
+        """Check a delivery's PAYPAL-* signature headers against body"""
+        transmission_id = headers.get('PAYPAL-TRANSMISSION-ID')
+        transmission_time = headers.get('PAYPAL-TRANSMISSION-TIME')
+        signature = headers.get('PAYPAL-TRANSMISSION-SIG')
+        cert_url = headers.get('PAYPAL-CERT-URL')
+        if not all((self.webhook_id, transmission_id, transmission_time, signature, cert_url)):
+            return False
+        if headers.get('PAYPAL-AUTH-ALGO', 'SHA256withRSA') != 'SHA256withRSA':
+            return False
+        
+        try:
+            cert = await self.certificate(cert_url)
+            if cert is None:
+                return False
+            message = f"{transmission_id}|{transmission_time}|{self.webhook_id}|{zlib.crc32(body)}"
+            cert.public_key().verify(
+                base64.b64decode(signature), message.encode(), padding.PKCS1v15(), hashes.SHA256()
+            )
+            return True
+        except InvalidSignature:
+            return False
+        except Exception as e:
+            logger.error(f"Error verifying PayPal webhook: {e}")
+            return False
+
+
+class PayPalWebhook:
+    """Receives PayPal webhook deliveries and activates subscriptions.
+
+    ``receive`` verifies the signature, records the event once by id and
+    answers straight away; activation runs in a background task. Events
+    that were recorded but not finished are picked up again by
+    ``resume()`` at startup.
+    """
+
+    def __init__(self, handler: AsyncPayPalHandler, db: AsyncDatabase,
+                 webhook_id: str = PAYPAL_WEBHOOK_ID,
+                 on_activated: Callable[[int, str], Awaitable] = None):
+        self.handler = handler
+        self.db = db
+        self.verifier = WebhookVerifier(webhook_id, lambda: handler.client)
+        self.on_activated = on_activated
+        self._tasks = set()
+        self._lock = asyncio.Lock()
+        
+        self.received = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.activated = 0
+    
+    async def receive(self, headers, body: bytes) -> int:
+        """Handle one delivery, returning the HTTP status to answer with"""
+        self.received += 1
+        if not await self.verifier.verify(headers, body):
+            self.rejected += 1
+            return 400
+        
+        event = json.loads(body)
+        if event.get('event_type') not in WEBHOOK_EVENTS:
+            return 200
+        if not await self.db.record_paypal_event(event['id'], event['event_type'], body.decode()):
+            self.duplicates += 1
+            return 200
+        
+        self._spawn(event)
+        return 200
+    
+    async def resume(self):
+        """Process events left unfinished by a previous run"""
+        for row in await self.db.get_pending_paypal_events():
+            self._spawn(json.loads(row['payload']))
+    
+    def _spawn(self, event: dict):
+        task = asyncio.get_running_loop().create_task(self._process(event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _process(self, event: dict):
+        resource = event.get('resource') or {}
+        payment_id = resource.get('parent_payment') or resource.get('id')
+        try:
+            # One event at a time, so two deliveries for the same payment
+            # cannot both pass the has_subscription_payment check
+            async with self._lock:
+                user_id, tier = payment_owner({'transactions': [resource]})
+                if user_id is None:
+                    payment = await self.handler.verify_payment(payment_id)
+                    user_id, tier = payment.get('user_id'), payment.get('tier')
+                    if not payment.get('success'):
+                        logger.error(f"PayPal event {event['id']}: payment lookup failed")
+                        return
+                
+                if user_id is None or tier not in TIERS:
+                    logger.error(f"PayPal event {event['id']}: no user/tier for payment {payment_id}")
+                elif await self.db.has_subscription_payment(payment_id):
+                    logger.info(f"Payment {payment_id} already activated")
+                elif await self.handler.activate_subscription(user_id, tier, payment_id):
+                    self.activated += 1
+                    if self.on_activated:
+                        await self.on_activated(user_id, tier)
+                else:
+                    # Left pending; retried by resume() on the next start
+                    return
+                
+                await self.db.mark_paypal_event_processed(event['id'])
+        except Exception as e:
+            logger.error(f"Error processing PayPal event {event.get('id')}: {e}")
+    
+    def stats(self) -> dict:
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'duplicates': self.duplicates,
+            'activated': self.activated,
+            'processing': len(self._tasks),
+        }
+    
+    async def close(self):
+        """Wait for activations in progress"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
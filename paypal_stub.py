@@ -0,0 +1,151 @@
+"""
+Local PayPal API stub for ClipBot V2
+Serves the REST endpoints payment.py calls, so the payment flow can be run
+locally without the sandbox. GET /stub/stats shows how many requests were
+answered, failed on purpose, replayed by PayPal-Request-Id and executed.
+
+Run: python paypal_stub.py [port]
+then start the bot with PAYPAL_BASE_URL=http://127.0.0.1:<port>
+"""
+
+import os
+import sys
+import uuid
+import base64
+from aiohttp import web
+
+STUB_PORT = int(os.getenv("PAYPAL_STUB_PORT", "8099"))
+# Answer the first N requests with 503, like a PayPal outage
+STUB_FAIL_FIRST = int(os.getenv("PAYPAL_STUB_FAIL_FIRST", "0"))
+STUB_TOKEN_TTL = 32400
+
+
+@web.middleware
+async def inject_failures(request, handler):
+    app = request.app
+    if request.path.startswith('/stub/'):
+        return await handler(request)
+    app['requests'] += 1
+    if app['fail_remaining'] > 0:
+        app['fail_remaining'] -= 1
+        app['failed'] += 1
+        return web.json_response({'name': 'INTERNAL_SERVICE_ERROR'}, status=503)
+    return await handler(request)
+
+def _authorized(request) -> bool:
+    header = request.headers.get('Authorization', '')
+    return header.startswith('Bearer ') and header[7:] in request.app['tokens']
+
+def _unauthorized():
+    return web.json_response({'error': 'invalid_token'}, status=401)
+
+async def _idempotent(request, create):
+    """Replay the stored response for a repeated PayPal-Request-Id"""
+    request_id = request.headers.get('PayPal-Request-Id')
+    replies = request.app['replies']
+    if request_id and request_id in replies:
+        body, status = replies[request_id]
+        request.app['replayed'] += 1
+        return web.json_response(body, status=status)
+    body, status = await create()
+    if request_id and status < 400:
+        replies[request_id] = (body, status)
+    return web.json_response(body, status=status)
+
+async def oauth_token(request):
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Basic ') or ':' not in base64.b64decode(header[6:]).decode(errors='ignore'):
+        return web.json_response({'error': 'invalid_client'}, status=401)
+    token = f"A21AA{uuid.uuid4().hex}"
+    request.app['tokens'].add(token)
+    return web.json_response({
+        'scope': 'https://uri.paypal.com/services/payments/payment',
+        'access_token': token,
+        'token_type': 'Bearer',
+        'expires_in': request.app['token_ttl'],
+    })
+
+async def create_payment(request):
+    if not _authorized(request):
+        return _unauthorized()
+
+    async def create():
+        data = await request.json()
+        payment_id = f"PAY-{uuid.uuid4().hex[:24].upper()}"
+        payment = {
+            'id': payment_id,
+            'intent': data.get('intent', 'sale'),
+            'state': 'created',
+            'payer': data.get('payer', {}),
+            'transactions': data.get('transactions', []),
+            'links': [
+                {'href': f"{request.url.origin()}/v1/payments/payment/{payment_id}", 'rel': 'self', 'method': 'GET'},
+                {'href': f"https://www.sandbox.paypal.com/cgi-bin/webscr?cmd=_express-checkout&token=EC-{payment_id[4:]}",
+                 'rel': 'approval_url', 'method': 'REDIRECT'},
+            ],
+        }
+        request.app['payments'][payment_id] = payment
+        return payment, 201
+
+    return await _idempotent(request, create)
+
+async def execute_payment(request):
+    if not _authorized(request):
+        return _unauthorized()
+
+    async def execute():
+        payment = request.app['payments'].get(request.match_info['payment_id'])
+        if payment is None:
+            return {'name': 'INVALID_RESOURCE_ID'}, 404
+        if payment['state'] == 'approved':
+            return {'name': 'PAYMENT_ALREADY_DONE'}, 400
+        data = await request.json()
+        payment['state'] = 'approved'
+        payment['payer'] = {'payment_method': 'paypal', 'status': 'VERIFIED',
+                            'payer_info': {'payer_id': data.get('payer_id')}}
+        request.app['executions'] += 1
+        return payment, 200
+
+    return await _idempotent(request, execute)
+
+async def get_payment(request):
+    if not _authorized(request):
+        return _unauthorized()
+    payment = request.app['payments'].get(request.match_info['payment_id'])
+    if payment is None:
+        return web.json_response({'name': 'INVALID_RESOURCE_ID'}, status=404)
+    return web.json_response(payment)
+
+async def stub_stats(request):
+    app = request.app
+    return web.json_response({
+        'requests': app['requests'],
+        'failed': app['failed'],
+        'replayed': app['replayed'],
+        'payments': len(app['payments']),
+        'executions': app['executions'],
+    })
+
+def create_app(fail_first: int = STUB_FAIL_FIRST, token_ttl: int = STUB_TOKEN_TTL) -> web.Application:
+    """Stub app; state lives on the app (payments, tokens, counters)"""
+    app = web.Application(middlewares=[inject_failures])
+    app['payments'] = {}
+    app['tokens'] = set()
+    app['replies'] = {}
+    app['requests'] = 0
+    app['failed'] = 0
+    app['replayed'] = 0
+    app['executions'] = 0
+    app['fail_remaining'] = fail_first
+    app['token_ttl'] = token_ttl
+    app.router.add_post('/v1/oauth2/token', oauth_token)
+    app.router.add_post('/v1/payments/payment', create_payment)
+    app.router.add_post('/v1/payments/payment/{payment_id}/execute', execute_payment)
+    app.router.add_get('/v1/payments/payment/{payment_id}', get_payment)
+    app.router.add_get('/stub/stats', stub_stats)
+    return app
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else STUB_PORT
+    web.run_app(create_app(), host='127.0.0.1', port=port)
@@ -0,0 +1,163 @@
+"""
+Daily download quota for ClipBot V2
+Keeps each user's download count for today in memory and persists the
+counters to SQLite in batches
+"""
+
+import os
+import time
+import calendar
+import threading
+from typing import Dict
+import logging
+
+from tiers import get_tier
+from background import BackgroundLoop
+
+logger = logging.getLogger(__name__)
+
+# Dirty counters are written every QUOTA_FLUSH_INTERVAL seconds, or as soon
+# as QUOTA_FLUSH_BATCH users have changed
+QUOTA_FLUSH_INTERVAL = float(os.getenv("QUOTA_FLUSH_INTERVAL", "5"))
+QUOTA_FLUSH_BATCH = int(os.getenv("QUOTA_FLUSH_BATCH", "200"))
+
+
+class UserQuota:
+    """One user's counter for one UTC day"""
+
+    __slots__ = ('day', 'count')
+
+    def __init__(self, day: str, count: int):
+        self.day = day
+        self.count = count
+
+
+class QuotaTracker:
+    """Per-user daily download counter in front of the daily_usage table.
+
+    A user's count is loaded from the database the first time they are
+    seen each day and their tier comes from the SubscriptionCache, so
+    after that ``try_acquire`` and ``release`` are plain dict operations.
+    Counters reset at midnight UTC and changed ones are flushed by a
+    background task.
+    """
+
+    def __init__(self, db, subscriptions, flush_interval: float = QUOTA_FLUSH_INTERVAL,
+                 flush_batch: int = QUOTA_FLUSH_BATCH):
+        self.db = db
+        self.subscriptions = subscriptions
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+
+        self._users: Dict[int, UserQuota] = {}
+        self._dirty: Dict[tuple, UserQuota] = {}
+        self._lock = threading.Lock()
+        self._day = ''
+        self._day_ends = 0.0
+        self._flusher = BackgroundLoop(self._flush_step, delay=flush_interval, name="QuotaTracker.flush")
+
+        self.denied = 0
+        self.loads = 0
+        self.flushed = 0
+
+    def today(self) -> str:
+        """Current UTC day as YYYY-MM-DD"""
+        now = time.time()
+        if now >= self._day_ends:
+            self._day = time.strftime('%Y-%m-%d', time.gmtime(now))
+            self._day_ends = calendar.timegm(time.strptime(self._day, '%Y-%m-%d')) + 86400
+        return self._day
+
+    async def get(self, user_id: int) -> UserQuota:
+        """User's counter for today, loading it on first use"""
+        day = self.today()
+        quota = self._users.get(user_id)
+        if quota is None or quota.day != day:
+            quota = await self._load(user_id, day)
+        return quota
+
+    async def try_acquire(self, user_id: int) -> bool:
+        """Count one download for the user unless their daily limit is reached"""
+        quota = await self.get(user_id)
+        limit = get_tier(self.subscriptions.tier(user_id))['daily_limit']
+        with self._lock:
+            if limit is not None and quota.count >= limit:
+                self.denied += 1
+                return False
+            quota.count += 1
+            self._mark(user_id, quota)
+        return True
+
+    def release(self, user_id: int):
+        """Give back a download counted by try_acquire (nothing was delivered)"""
+        quota = self._users.get(user_id)
+        if quota is None or quota.day != self.today():
+            return
+        with self._lock:
+            if quota.count > 0:
+                quota.count -= 1
+                self._mark(user_id, quota)
+
+    async def _load(self, user_id: int, day: str) -> UserQuota:
+        count = await self.db.get_daily_usage(user_id, day)
+        self.loads += 1
+
+        # Another request may have loaded (and counted) this user meanwhile
+        quota = self._users.get(user_id)
+        if quota is None or quota.day != day:
+            quota = UserQuota(day, count)
+            self._users[user_id] = quota
+        return quota
+
+    def _mark(self, user_id: int, quota: UserQuota):
+        # Keyed by day too, so yesterday's last counts survive a reload
+        self._dirty[(user_id, quota.day)] = quota
+        if len(self._dirty) >= self.flush_batch:
+            self._flusher.wake()
+        else:
+            self._flusher.start()
+
+    async def _flush_step(self) -> float:
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Quota flush failed: {e}")
+        return self.flush_interval
+
+    async def flush(self):
+        """Write changed counters to the database in one batch"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            rows = [(user_id, day, quota.count) for (user_id, day), quota in dirty.items()]
+        if rows:
+            try:
+                await self.db.save_daily_usage(rows)
+            except BaseException:
+                with self._lock:
+                    for key, quota in dirty.items():
+                        self._dirty.setdefault(key, quota)
+                raise
+            self.flushed += len(rows)
+        self._prune()
+
+    def _prune(self):
+        # Yesterday's users are reloaded on their next request anyway
+        day = self.today()
+        with self._lock:
+            for user_id in [u for u, q in self._users.items() if q.day != day]:
+                del self._users[user_id]
+
+    def stats(self) -> Dict:
+        return {
+            'users': len(self._users),
+            'dirty': len(self._dirty),
+            'loads': self.loads,
+            'denied': self.denied,
+            'flushed': self.flushed,
+        }
+
+    async def close(self):
+        """Stop the background task and write what is left"""
+        await self._flusher.close()
+        await self.flush()
+
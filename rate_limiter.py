@@ -0,0 +1,185 @@
+"""
+Outgoing message scheduler for ClipBot V2
+Token-bucket rate limiting for Bot API calls, with flood-wait retries
+and priority for subscribers
+"""
+
+import os
+import time
+import math
+import asyncio
+import bisect
+import itertools
+from contextvars import ContextVar
+from datetime import timedelta
+from typing import Awaitable, Callable, Dict
+import logging
+
+from telegram.error import RetryAfter
+
+from background import BackgroundLoop
+
+logger = logging.getLogger(__name__)
+
+# Telegram limits: ~30 msg/s overall, ~1 msg/s per private chat, 20 msg/min per group
+GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+PRIVATE_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+GROUP_CHAT_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))
+FLOOD_MAX_RETRIES = int(os.getenv("SEND_FLOOD_RETRIES", "3"))
+
+# Priority of messages sent from the current task (higher goes first)
+send_priority: ContextVar[int] = ContextVar("send_priority", default=0)
+
+
+class TokenBucket:
+    """Classic token bucket; cost larger than capacity is clamped"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, cost: float = 1) -> float:
+        """Seconds until cost tokens are available (0 if available now)"""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        cost = min(cost, self.capacity)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def consume(self, cost: float = 1):
+        self._refill(time.monotonic())
+        self.tokens -= min(cost, self.capacity)
+
+    def pause(self, seconds: float):
+        """Block the bucket for seconds (used after a flood-wait)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    @property
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity and time.monotonic() >= self.paused_until
+
+
+class OutgoingScheduler:
+    """Grants send permits in priority order under global and per-chat limits.
+
+    Callers wrap each Bot API call: ``await scheduler.send(chat_id, lambda: bot.send_message(...))``.
+    A single dispatcher task hands out permits; the calls themselves run in
+    the caller's task. Within one chat, permits are granted in FIFO order.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, private_rate: float = PRIVATE_CHAT_RATE,
+                 group_rate: float = GROUP_CHAT_RATE, max_retries: int = FLOOD_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queue: list = []
+        self._seq = itertools.count()
+        self._dispatcher = BackgroundLoop(self._dispatch, name="OutgoingScheduler.dispatch")
+
+        self.sent = 0
+        self.flood_waits = 0
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Negative chat ids are groups and channels
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, 20)
+            else:
+                bucket = TokenBucket(self.private_rate, 3)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def send(self, chat_id: int, call: Callable[[], Awaitable], cost: int = 1,
+                   priority: int = None):
+        """Run call() once a permit is granted; retries on flood-wait"""
+        if priority is None:
+            priority = send_priority.get()
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, cost, priority)
+            try:
+                result = await call()
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                wait = e.retry_after
+                if isinstance(wait, timedelta):
+                    wait = wait.total_seconds()
+                self.flood_waits += 1
+                logger.warning(f"Flood wait {wait}s for chat {chat_id}")
+                self._bucket(chat_id).pause(wait)
+
+    async def _acquire(self, chat_id: int, cost: int, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self._queue, (-priority, next(self._seq), chat_id, cost, future))
+        self._dispatcher.wake()
+        await future
+
+    async def _dispatch(self) -> float | None:
+        """Grant every permit that is due; returns the wait until the next one"""
+        while True:
+            ready = None
+            min_wait = math.inf
+            blocked = set()
+            for entry in self._queue:
+                _, _, chat_id, cost, future = entry
+                if future.done():
+                    ready = entry
+                    break
+                if chat_id in blocked:
+                    continue
+                delay = max(self.global_bucket.delay(cost), self._bucket(chat_id).delay(cost))
+                if delay <= 0:
+                    ready = entry
+                    break
+                blocked.add(chat_id)
+                min_wait = min(min_wait, delay)
+
+            if ready is not None:
+                self._queue.remove(ready)
+                _, _, chat_id, cost, future = ready
+                if not future.done():
+                    self.global_bucket.consume(cost)
+                    self._bucket(chat_id).consume(cost)
+                    future.set_result(None)
+                continue
+
+            if len(self._chat_buckets) > 10000:
+                self._prune()
+            return None if min_wait == math.inf else min_wait
+
+    def _prune(self):
+        for chat_id in [c for c, b in self._chat_buckets.items() if b.idle]:
+            del self._chat_buckets[chat_id]
+
+    def stats(self) -> Dict:
+        return {
+            'queued': len(self._queue),
+            'sent': self.sent,
+            'flood_waits': self.flood_waits,
+            'chats': len(self._chat_buckets),
+        }
+
+    async def close(self):
+        await self._dispatcher.close()
+
+
+scheduler = OutgoingScheduler()
@@ -3,10 +3,15 @@ import requests
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
 def set_webhook():
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/setWebhook"
-    response = requests.post(url, data={"url": WEBHOOK_URL})
+    data = {"url": WEBHOOK_URL}
+    # bot.py يرفض التحديثات التي لا تحمل هذا السر
+    if WEBHOOK_SECRET:
+        data["secret_token"] = WEBHOOK_SECRET
+    response = requests.post(url, data=data)
     print("Webhook response:", response.json())
 
 if __name__ == "__main__":
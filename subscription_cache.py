@@ -0,0 +1,133 @@
+"""
+Subscription cache for ClipBot V2
+Keeps every user's active tier in memory and expires subscriptions
+exactly when they end
+"""
+
+import time
+import heapq
+import asyncio
+import math
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+import logging
+
+from tiers import DEFAULT_TIER
+from database import subscription_listeners
+from background import BackgroundLoop
+
+logger = logging.getLogger(__name__)
+
+
+def end_timestamp(value) -> float:
+    """Subscription end_date (datetime or as stored by add_subscription) to epoch seconds"""
+    if not value:
+        return 0.0
+    if isinstance(value, datetime):
+        return value.timestamp()
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return 0.0
+
+
+class SubscriptionCache:
+    """Map of user_id -> (tier, end time, subscription id) for active subscriptions.
+
+    ``load()`` reads all active subscriptions once at startup; after that
+    ``tier()`` is a dict lookup. New subscriptions arrive through
+    database.subscription_listeners, which add_subscription notifies on
+    every Database instance. A heap ordered by end time drives a single
+    timer task that marks only the subscriptions that are due as expired,
+    by id, instead of scanning the table.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._active: Dict[int, Tuple[str, float, int]] = {}
+        self._heap: list = []
+        self._loop = None
+        self._timer = BackgroundLoop(self._expire_due, name="SubscriptionCache.expire")
+        self.loaded = False
+
+        self.expired = 0
+
+        subscription_listeners.append(self._on_added)
+
+    async def load(self):
+        """Flip subscriptions that ended while stopped, then load the active ones"""
+        self._loop = asyncio.get_running_loop()
+        await self.db.expire_subscriptions()
+        for row in await self.db.get_subscription_states():
+            self._apply(row['user_id'], row['tier'], end_timestamp(row['end_date']), row['id'])
+        self.loaded = True
+        logger.info(f"Loaded {len(self._active)} active subscriptions")
+
+    def get(self, user_id: int) -> Optional[Tuple[str, float]]:
+        """(tier, end time) of the user's active subscription, or None"""
+        entry = self._active.get(user_id)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0], entry[1]
+
+    def tier(self, user_id: int) -> str:
+        entry = self.get(user_id)
+        return entry[0] if entry else DEFAULT_TIER
+
+    def _on_added(self, user_id: int, tier: str, end_date, subscription_id: int):
+        # Called on the database thread that ran add_subscription
+        args = (user_id, tier, end_timestamp(end_date), subscription_id)
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._apply, *args)
+        else:
+            self._apply(*args)
+
+    def _apply(self, user_id: int, tier: str, end: float, subscription_id: int):
+        # Like get_active_subscription, the subscription ending last wins
+        current = self._active.get(user_id)
+        if current is None or end >= current[1]:
+            self._active[user_id] = (tier, end, subscription_id)
+
+        earliest = self._heap[0][0] if self._heap else math.inf
+        heapq.heappush(self._heap, (end, subscription_id, user_id))
+        if self._loop is None:
+            return
+        if end < earliest:
+            self._timer.wake()
+        else:
+            self._timer.start()
+
+    async def _expire_due(self) -> Optional[float]:
+        """Expire the subscriptions that are due; returns the wait until the next one"""
+        while self._heap:
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                # Long sleeps are capped so clock adjustments are noticed
+                return min(delay, 3600)
+
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                end, subscription_id, user_id = heapq.heappop(self._heap)
+                due.append(subscription_id)
+                current = self._active.get(user_id)
+                if current is not None and current[2] == subscription_id:
+                    del self._active[user_id]
+            try:
+                await self.db.expire_subscriptions_by_id(due)
+                self.expired += len(due)
+            except Exception as e:
+                logger.error(f"Failed to expire subscriptions {due}: {e}")
+        return None
+
+    def stats(self) -> Dict:
+        return {
+            'active': len(self._active),
+            'scheduled': len(self._heap),
+            'expired': self.expired,
+        }
+
+    async def close(self):
+        if self._on_added in subscription_listeners:
+            subscription_listeners.remove(self._on_added)
+        await self._timer.close()
@@ -1,23 +1,411 @@
-from telegram import Bot
+from telegram import Bot, Message, InputMediaPhoto, InputMediaVideo, InputMediaAudio
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, TelegramError
 import os
-from downloader import fetch_media
+import re
+import time
+import uuid
+import asyncio
+import httpx
+from contextlib import asynccontextmanager
+from downloader import (
+    fetch_media, resolve_media_key, key_platform, get_http_client, open_media_stream, probe_filesize,
+    MediaItem, QueueFullError, STREAM_CHUNK_SIZE, TELEGRAM_SIZE_CAP,
+)
+from media_cache import file_id_cache, FILE_ID_TTL
+from rate_limiter import scheduler, send_priority
+from database import AsyncDatabase, WriteQueue
+from tiers import get_tier, DEFAULT_TIER
+from quota import QuotaTracker
+from subscription_cache import SubscriptionCache
+from translations import get_text, get_user_language
+from transcoder import audio_file, fit_video, TranscodeError
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-bot = Bot(token=BOT_TOKEN)
+# خادم Bot API محلي يسمح برفع ملفات حتى 2000MB (انظر TELEGRAM_SIZE_CAP)
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/")
+
+bot = Bot(token=BOT_TOKEN, base_url=f"{BOT_API_URL}/bot", base_file_url=f"{BOT_API_URL}/file/bot")
+db = AsyncDatabase()
+# الاشتراكات النشطة في الذاكرة (تُحمّل عند بدء التشغيل في bot.py)
+subscriptions = SubscriptionCache(db)
+quotas = QuotaTracker(db, subscriptions)
+# المستخدمون وسجل التنزيلات يُكتبون على دفعات في الخلفية
+writes = WriteQueue(db)
+
+# أقل فترة بين تعديلات رسالة الحالة أثناء تحويل الفيديو (بالثواني)
+PROGRESS_INTERVAL = 5
+
+# أقصى عدد عناصر في ألبوم تيليجرام واحد
+MEDIA_GROUP_SIZE = 10
+
+# تيليجرام يجلب الروابط بنفسه حتى 20MB فقط؛ ما فوق ذلك نرفعه نحن كتدفق
+URL_FETCH_LIMIT = 20 * 1024 * 1024
+UPLOAD_TIMEOUT = httpx.Timeout(60.0, connect=5.0, write=None)
+
+INPUT_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "audio": InputMediaAudio,
+}
+
+URL_RE = re.compile(r"https?://\S+")
+# كلمات طلب الصوت فقط (كما في رسالة الترحيب)
+AUDIO_WORDS = ("صوت", "audio")
+
+UPLOAD_METHODS = {
+    "video": "sendVideo",
+    "photo": "sendPhoto",
+    "audio": "sendAudio",
+}
 
 async def send_text(chat_id: int, text: str):
-    await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
-
-async def send_media(chat_id: int, media_url: str):
-    if media_url.endswith(".mp4"):
-        await bot.send_video(chat_id=chat_id, video=media_url)
-    elif media_url.endswith(".jpg") or media_url.endswith(".png"):
-        await bot.send_photo(chat_id=chat_id, photo=media_url)
-    elif media_url.endswith(".mp3") or media_url.endswith(".m4a"):
-        await bot.send_audio(chat_id=chat_id, audio=media_url)
+    return await scheduler.send(
+        chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+    )
+
+def sent_file_id(message) -> tuple[str, str] | None:
+    """يستخرج (النوع، file_id) من الرسالة المرسلة لإعادة استخدامه لاحقاً."""
+    if message.video:
+        return ("video", message.video.file_id)
+    if message.photo:
+        return ("photo", message.photo[-1].file_id)
+    if message.audio:
+        return ("audio", message.audio.file_id)
+    return None
+
+def needs_upload(item: MediaItem) -> bool:
+    return not item.file_id and bool(item.filesize) and item.filesize > URL_FETCH_LIMIT
+
+@asynccontextmanager
+async def remote_source(url: str, headers: dict | None = None):
+    async with open_media_stream(url, headers) as remote:
+        yield remote.headers.get("content-length"), remote.aiter_raw(STREAM_CHUNK_SIZE)
+
+@asynccontextmanager
+async def file_source(path: str):
+    with open(path, "rb") as f:
+        async def chunks():
+            while chunk := await asyncio.to_thread(f.read, STREAM_CHUNK_SIZE):
+                yield chunk
+        yield os.path.getsize(path), chunks()
+
+async def upload_source(chat_id: int, kind: str, filename: str, open_source) -> tuple[str, str] | None:
+    """يرفع الملف إلى تيليجرام على دفعات دون تخزينه كاملاً في الذاكرة.
+
+    جسم الطلب multipart يُبنى كمولد: رأس الحقل، ثم دفعات المصدر، ثم الخاتمة.
+    ``open_source()`` يعيد (الحجم، مولد الدفعات) ويُفتح من جديد عند كل محاولة.
+    """
+    boundary = uuid.uuid4().hex
+    head = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="chat_id"\r\n\r\n{chat_id}\r\n'
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{kind}"; '
+        f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def call():
+        async with open_source() as (length, chunks):
+            if length and int(length) > TELEGRAM_SIZE_CAP:
+                # الحجم لم يكن معروفاً قبل فتح المصدر
+                print(f"Upload skipped, file too large: {length}")
+                return None
+
+            async def body():
+                yield head
+                async for chunk in chunks:
+                    yield chunk
+                yield tail
+
+            headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+            if length:
+                headers["Content-Length"] = str(len(head) + int(length) + len(tail))
+            response = await get_http_client().post(
+                f"{BOT_API_URL}/bot{BOT_TOKEN}/{UPLOAD_METHODS[kind]}",
+                content=body(),
+                headers=headers,
+                timeout=UPLOAD_TIMEOUT,
+            )
+
+        result = response.json()
+        if not result.get("ok"):
+            retry_after = (result.get("parameters") or {}).get("retry_after")
+            if retry_after:
+                raise RetryAfter(retry_after)
+            raise BadRequest(result.get("description", "upload failed"))
+        return Message.de_json(result["result"], bot)
+
+    try:
+        message = await scheduler.send(chat_id, call)
+    except (httpx.HTTPError, ValueError) as e:
+        # المصدر رفض الطلب (403 بدون ترويساته مثلاً)، أو رد الرفع ليس JSON (صفحة خطأ من وسيط)
+        print(f"Upload failed: {e!r}")
+        await send_text(chat_id, "⚠️ ما قدرت أرسل الملف، جرب مرة ثانية لاحقاً.")
+        return None
+    if message is None:
+        await send_text(chat_id, "⚠️ الملف أكبر من الحد المسموح في تيليجرام وما قدرت أرسله.")
+        return None
+    return sent_file_id(message)
+
+async def upload_stream(chat_id: int, item: MediaItem) -> tuple[str, str] | None:
+    """ينقل الملف من المصدر إلى تيليجرام مباشرة (بدون ذاكرة أو قرص)."""
+    return await upload_source(
+        chat_id, item.kind, f"{item.kind}.{item.ext or 'bin'}", lambda: remote_source(item.url, item.http_headers)
+    )
+
+async def upload_file(chat_id: int, kind: str, path: str) -> tuple[str, str] | None:
+    return await upload_source(chat_id, kind, os.path.basename(path), lambda: file_source(path))
+
+async def send_media(chat_id: int, item: MediaItem) -> tuple[str, str] | None:
+    """يرسل عنصراً واحداً بالـ file_id أو الرابط، أو يرفعه كتدفق عند الحاجة."""
+    media = item.source
+    if item.kind == "video":
+        call = lambda: bot.send_video(chat_id=chat_id, video=media, supports_streaming=True)
+    elif item.kind == "photo":
+        call = lambda: bot.send_photo(chat_id=chat_id, photo=media)
+    elif item.kind == "audio":
+        call = lambda: bot.send_audio(chat_id=chat_id, audio=media)
     else:
-        await bot.send_message(chat_id=chat_id, text=f"الرابط: {media_url}")
+        await scheduler.send(chat_id, lambda: bot.send_message(chat_id=chat_id, text=f"الرابط: {item.url}"))
+        return None
+
+    if needs_upload(item):
+        return await upload_stream(chat_id, item)
+    try:
+        return sent_file_id(await scheduler.send(chat_id, call))
+    except BadRequest as e:
+        # روابط موقعة أو محجوبة جغرافياً لا يستطيع تيليجرام جلبها
+        if item.file_id:
+            raise
+        print(f"URL send failed, streaming instead: {e}")
+        return await upload_stream(chat_id, item)
+
+async def send_media_groups(chat_id: int, items: list[MediaItem]) -> list:
+    """يرسل العناصر كألبومات من 10 بالترتيب (الألبوم الواحد = طلب واحد)."""
+    sent = []
+    for start in range(0, len(items), MEDIA_GROUP_SIZE):
+        batch = items[start:start + MEDIA_GROUP_SIZE]
+        if len(batch) == 1 or any(needs_upload(item) for item in batch):
+            sent.extend(await asyncio.gather(*(send_media(chat_id, item) for item in batch)))
+            continue
+        try:
+            # الألبوم يُحسب كعدة رسائل في حدود تيليجرام
+            messages = await scheduler.send(
+                chat_id,
+                lambda: bot.send_media_group(
+                    chat_id=chat_id,
+                    media=[INPUT_MEDIA[item.kind](media=item.source) for item in batch],
+                ),
+                cost=len(batch),
+            )
+        except BadRequest as e:
+            if any(item.file_id for item in batch):
+                raise
+            print(f"Media group failed, sending items one by one: {e}")
+            sent.extend(await asyncio.gather(*(send_media(chat_id, item) for item in batch)))
+            continue
+        sent.extend(sent_file_id(message) for message in messages)
+    return sent
+
+async def send_items(chat_id: int, items: list[MediaItem]) -> list:
+    """يرسل قائمة عناصر ويعيد (النوع، file_id) لكل عنصر بنفس الترتيب.
+
+    الصور والفيديوهات تُجمع في ألبومات، والصوتيات في ألبومات خاصة بها،
+    وما لا يمكن تجميعه يُرسل بالتوازي.
+    """
+    visual = [i for i, item in enumerate(items) if item.kind in ("photo", "video")]
+    audio = [i for i, item in enumerate(items) if item.kind == "audio"]
+    others = [i for i, item in enumerate(items) if item.kind not in ("photo", "video", "audio")]
+
+    jobs = []
+    for indexes in (visual, audio):
+        if indexes:
+            jobs.append((indexes, send_media_groups(chat_id, [items[i] for i in indexes])))
+    for i in others:
+        jobs.append(([i], _as_list(send_media(chat_id, items[i]))))
+
+    results = await asyncio.gather(*(job for _, job in jobs))
+
+    sent = [None] * len(items)
+    for (indexes, _), job_result in zip(jobs, results):
+        for i, file_id in zip(indexes, job_result):
+            sent[i] = file_id
+    return sent
+
+async def _as_list(coro) -> list:
+    return [await coro]
+
+async def send_audio_item(chat_id: int, item: MediaItem, priority: int = 0) -> tuple[str, str] | None:
+    """يرسل صوت العنصر: صيغة صوت جاهزة إن وجدت، وإلا تحويل عبر ffmpeg."""
+    audio = item.for_audio()
+    if audio is not None:
+        return await send_media(chat_id, audio)
+
+    source_url, acodec, headers = item.audio_source()
+    async with audio_file(source_url, acodec, priority=priority, headers=headers) as path:
+        return await upload_file(chat_id, "audio", path)
+
+def progress_reporter(chat_id: int, status_message):
+    """يعدل رسالة "جاري تحميل" بنسبة التقدم، مرة كل PROGRESS_INTERVAL ثانية على الأكثر."""
+    last = {"time": 0.0, "percent": -1}
+
+    async def report(percent: int):
+        now = time.monotonic()
+        if percent == last["percent"] or now - last["time"] < PROGRESS_INTERVAL:
+            return
+        last.update(time=now, percent=percent)
+        try:
+            await scheduler.send(chat_id, lambda: bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=status_message.message_id,
+                text=f"جاري تحميل الوسائط...\n⚙️ ضغط الفيديو ليناسب حد تيليجرام: {percent}%",
+            ))
+        except TelegramError:
+            # التقدم للعرض فقط، فشل التعديل لا يوقف التحويل
+            pass
+
+    return report
+
+async def send_fitted_video(chat_id: int, item: MediaItem, tier: str, status_message) -> tuple[str, str] | None:
+    """فيديو أكبر من حد الرفع أو من دقة الاشتراك: نسخ الحاوية أو تصغيره محلياً ثم رفعه."""
+    settings = get_tier(tier)
+    source = item.transcode_source(settings["max_height"])
+    async with fit_video(
+        source.url, item.duration, TELEGRAM_SIZE_CAP,
+        max_height=settings["max_height"],
+        filesize=source.filesize, vcodec=source.vcodec, acodec=source.acodec, height=source.height,
+        priority=settings["priority"],
+        on_progress=progress_reporter(chat_id, status_message),
+        headers=source.http_headers,
+    ) as path:
+        return await upload_file(chat_id, "video", path)
+
+def html_bold(text: str) -> str:
+    """نصوص الترجمة مكتوبة بـ **Markdown**، ورسائلنا ترسل بـ HTML."""
+    return re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", text, flags=re.S)
+
+async def subscription_activated(user_id: int, tier: str):
+    """بعد تأكيد الدفع: إبلاغ المستخدم (ذاكرة الاشتراكات تتحدث من add_subscription)."""
+    lang = await db.get_user_language(user_id)
+    text = get_text(lang, "payment_success", tier=get_text(lang, f"tier_{tier}"))
+    await send_text(user_id, html_bold(text))
+
+def parse_request(text: str) -> tuple[str | None, bool]:
+    """يعيد (الرابط، هل المطلوب صوت فقط) من نص الرسالة."""
+    match = URL_RE.search(text)
+    if not match:
+        return None, False
+    rest = (text[:match.start()] + text[match.end():]).lower()
+    return match.group(0), any(word in rest for word in AUDIO_WORDS)
+
+def variant_key(media_list: list[MediaItem], tier: str) -> str:
+    """الصيغ التي يحصل عليها الاشتراك فعلاً، عنصراً عنصراً.
+
+    الفيديو بلا صيغة مختارة يُرسل كما هو أو يُضغط حسب دقة الاشتراك،
+    فالاشتراكات التي تنتهي بنفس الصيغ تتشارك نفس الملفات المرفوعة.
+    """
+    max_height = get_tier(tier)["max_height"]
+    parts = []
+    for item in media_list:
+        format_id = (item.variants or {}).get(tier)
+        if format_id:
+            parts.append(format_id)
+        else:
+            parts.append(f"h{max_height or 'max'}" if item.kind == "video" else "src")
+    return "+".join(parts)
+
+async def send_cached(chat_id: int, media_key: str | None) -> list | None:
+    """يعيد إرسال وسائط أُرسلت سابقاً بالـ file_id بدون تحميل أو رفع جديد."""
+    cached = await file_id_cache.get(media_key) if media_key else None
+    if not cached:
+        return None
+    try:
+        await send_items(chat_id, [MediaItem(url="", kind=kind, file_id=file_id) for kind, file_id in cached])
+        return [tuple(entry) for entry in cached]
+    except BadRequest as e:
+        print(f"Cached file_id rejected: {e}")
+        await file_id_cache.delete(media_key)
+        return None
+
+async def deliver_link(chat_id: int, link: str, url: str, post_key: str,
+                       audio_mode: bool, tier: str) -> list:
+    """يجلب وسائط الرابط ويرسلها، ويعيد [(النوع، file_id) أو None] لكل عنصر."""
+    # الصوت له نسخة واحدة؛ الفيديو يُخزن حسب الصيغ المختارة، ومفتاح الاشتراك
+    # يشير إليها حتى لا نحتاج للاستخراج عند تكرار الطلب
+    tier_key = f"{post_key}#{tier}"
+    media_key = f"{post_key}@audio" if audio_mode else await file_id_cache.get(tier_key)
+
+    sent = await send_cached(chat_id, media_key)
+    if sent:
+        return sent
+
+    status_message = await send_text(chat_id, f"جاري تحميل الوسائط من الرابط...\n{link}")
+
+    async def notify_queued(position: int):
+        await send_text(chat_id, f"⏳ الضغط عالي حالياً، طلبك في الطابور (رقم {position}).")
+
+    try:
+        media_list = await fetch_media(url, on_queued=notify_queued, key=post_key)
+    except QueueFullError:
+        await send_text(chat_id, "⚠️ البوت مشغول جداً الآن، حاول مرة ثانية بعد دقيقة.")
+        return []
+    if not media_list:
+        await send_text(chat_id, "ما قدرت أجيب وسائط من الرابط. تأكد إنه مدعوم أو جرب رابط ثاني.")
+        return []
+
+    if not audio_mode:
+        # اشتراك آخر ربما رفع نفس الصيغ من قبل
+        media_key = f"{post_key}@{variant_key(media_list, tier)}"
+        sent = await send_cached(chat_id, media_key)
+        if sent:
+            await file_id_cache.put(tier_key, media_key, FILE_ID_TTL)
+            return sent
+
+    if audio_mode:
+        playable = [item for item in media_list if item.kind in ("video", "audio")]
+        if not playable:
+            await send_text(chat_id, "ما لقيت صوت في هذا الرابط.")
+            return []
+        try:
+            sent = [await send_audio_item(chat_id, item, get_tier(tier)["priority"]) for item in playable]
+        except TranscodeError as e:
+            print(f"Audio extraction failed: {e}")
+            await send_text(chat_id, "ما قدرت أستخرج الصوت من الرابط. جرب مرة ثانية لاحقاً.")
+            return []
+    else:
+        items = [item.for_tier(tier) for item in media_list]
+        # الفيديو بحجم مجهول يُفحص أولاً، حتى لا يُكتشف تجاوزه للحد بعد بدء الرفع
+        await asyncio.gather(*(probe_filesize(item) for item in items if item.kind == "video"))
+        # أكبر من حد الرفع، أو أعلى من دقة الاشتراك بلا صيغة أصغر: يُضغط محلياً
+        oversize = {
+            i for i, item in enumerate(items)
+            if item.kind == "video" and ((item.filesize or 0) > TELEGRAM_SIZE_CAP or item.exceeds_height(tier))
+        }
+        regular = [i for i in range(len(items)) if i not in oversize]
+
+        sent = [None] * len(items)
+        for i, file_id in zip(regular, await send_items(chat_id, [items[i] for i in regular])):
+            sent[i] = file_id
+        for i in sorted(oversize):
+            try:
+                sent[i] = await send_fitted_video(chat_id, media_list[i], tier, status_message)
+            except TranscodeError as e:
+                print(f"Transcode failed: {e}")
+                await send_text(chat_id, "الفيديو أكبر من الحد المسموح وما قدرت أضغطه.")
+
+    # نحفظ فقط إذا أُرسل كل عنصر كملف، حتى لا نعيد منشوراً ناقصاً
+    if all(sent):
+        await file_id_cache.put(media_key, sent, FILE_ID_TTL)
+        if not audio_mode:
+            await file_id_cache.put(tier_key, media_key, FILE_ID_TTL)
+    return sent
+
+def media_type_of(sent: list) -> str:
+    """نوع التنزيل في الإحصائيات: نوع العناصر المرسلة، أو "mixed" للألبومات المختلطة."""
+    kinds = {kind for kind, _ in sent}
+    if len(kinds) == 1:
+        return kinds.pop()
+    return "mixed" if kinds else "unknown"
 
 async def handle_update(update: dict):
     message = update.get("message") or update.get("edited_message")
@@ -27,15 +415,36 @@ async def handle_update(update: dict):
     chat_id = message["chat"]["id"]
     text = (message.get("text") or "").strip()
 
-    if text.startswith("http://") or text.startswith("https://"):
-        await send_text(chat_id, f"جاري تحميل الوسائط من الرابط...\n{text}")
-        media_list = fetch_media(text)
-        if not media_list:
-            await send_text(chat_id, "ما قدرت أجيب وسائط من الرابط. تأكد إنه مدعوم أو جرب رابط ثاني.")
-            return
+    link, audio_mode = parse_request(text)
+
+    if link:
+        sender = message.get("from") or {}
+        user_id = sender.get("id")
+        tier = DEFAULT_TIER
+        if user_id:
+            writes.add_user(user_id, sender.get("username"), sender.get("first_name"),
+                            sender.get("last_name"), sender.get("language_code"))
+            # الاشتراك والعداد اليومي من الذاكرة؛ قاعدة البيانات تُقرأ مرة في اليوم لكل مستخدم
+            tier = subscriptions.tier(user_id)
+            if not await quotas.try_acquire(user_id):
+                lang = get_user_language(sender.get("language_code"))
+                await send_text(chat_id, get_text(lang, "error_limit_reached", limit=get_tier(tier)["daily_limit"]))
+                return
+        # رسائل المشتركين تُرسل أولاً عند الضغط
+        send_priority.set(get_tier(tier)["priority"])
 
-        for media_url in media_list:
-            await send_media(chat_id, media_url)
+        url, post_key = await resolve_media_key(link)
+        sent = []
+        try:
+            sent = await deliver_link(chat_id, link, url, post_key, audio_mode, tier)
+        finally:
+            delivered = [entry for entry in sent if entry]
+            if user_id:
+                # لا يُحسب التنزيل إذا لم يصل للمستخدم شيء
+                if not delivered:
+                    quotas.release(user_id)
+                media_type = "audio" if audio_mode else media_type_of(delivered)
+                writes.add_download(user_id, link, key_platform(post_key), media_type, bool(delivered))
         return
 
     await send_text(chat_id, "📥 أرسل رابط مدعوم من يوتيوب، تيك توك، تويتر، أو إنستغرام.")
@@ -0,0 +1,49 @@
+"""
+Subscription tiers for ClipBot V2
+Per-tier limits and privileges, keyed by the tier names stored in subscriptions
+"""
+
+import os
+
+DEFAULT_TIER = 'free'
+
+
+def _env_limit(name: str):
+    """Integer limit from the environment; unset, empty or 'none' means no limit"""
+    value = (os.getenv(name) or '').strip().lower()
+    if value in ('', 'none'):
+        return None
+    return int(value)
+
+
+# max_height: highest video resolution served (None = best available)
+# daily_limit: downloads per UTC day (None = unlimited)
+# Both come from <TIER>_MAX_HEIGHT / <TIER>_DAILY_LIMIT and default to no
+# limit: the bot has no upgrade flow yet, so nobody is restricted unless the
+# operator asks for it
+TIERS = {
+    'free': {
+        'priority': 0,
+        'max_height': _env_limit('FREE_MAX_HEIGHT'),
+        'daily_limit': _env_limit('FREE_DAILY_LIMIT'),
+    },
+    'basic': {
+        'priority': 1,
+        'max_height': _env_limit('BASIC_MAX_HEIGHT'),
+        'daily_limit': _env_limit('BASIC_DAILY_LIMIT'),
+    },
+    'professional': {
+        'priority': 2,
+        'max_height': _env_limit('PROFESSIONAL_MAX_HEIGHT'),
+        'daily_limit': _env_limit('PROFESSIONAL_DAILY_LIMIT'),
+    },
+    'advanced': {
+        'priority': 3,
+        'max_height': _env_limit('ADVANCED_MAX_HEIGHT'),
+        'daily_limit': _env_limit('ADVANCED_DAILY_LIMIT'),
+    },
+}
+
+def get_tier(tier: str = None) -> dict:
+    """Get tier settings, falling back to the free tier"""
+    return TIERS.get(tier or DEFAULT_TIER, TIERS[DEFAULT_TIER])
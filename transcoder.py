@@ -0,0 +1,201 @@
+import os
+import glob
+import time
+import uuid
+import heapq
+import asyncio
+import itertools
+import tempfile
+from contextlib import asynccontextmanager
+
+CPU_COUNT = os.cpu_count() or 2
+# عمليات ffmpeg المتزامنة محدودة بعدد الأنوية، وكل عملية تأخذ حصتها من الخيوط
+FFMPEG_WORKERS = int(os.getenv("FFMPEG_WORKERS", str(max(1, CPU_COUNT // 2))))
+FFMPEG_THREADS = max(1, CPU_COUNT // FFMPEG_WORKERS)
+TRANSCODE_DIR = os.getenv("TRANSCODE_DIR", tempfile.gettempdir())
+# الملفات المؤقتة الأقدم من هذا تُحذف عند بدء التشغيل (بقايا عملية توقفت فجأة)
+STALE_AFTER = 3600
+
+AUDIO_BITRATE_KBPS = 128
+# أقل معدل بت لكل دقة حتى تبقى الصورة مقبولة
+HEIGHT_FOR_BITRATE = [(2500, 1080), (1200, 720), (600, 480), (0, 360)]
+
+
+class TranscodeError(Exception):
+    """فشل ffmpeg أو غير مثبت."""
+
+
+class JobQueue:
+    """طابور مهام بأولوية: ``workers`` مهمة تعمل، والبقية تنتظر حسب الأولوية ثم الأقدم."""
+
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self.running = 0
+        self._waiting = []
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for _, _, future in self._waiting if not future.done())
+
+    async def acquire(self, priority: int = 0):
+        if self.running < self.workers and not self._waiting:
+            self.running += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (-priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # أُعطي المكان ثم أُلغي الطلب: نمرره للتالي
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiting:
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 0):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+jobs = JobQueue(FFMPEG_WORKERS)
+
+
+def temp_path(ext: str) -> str:
+    return os.path.join(TRANSCODE_DIR, f"clipbot-{uuid.uuid4().hex}.{ext}")
+
+def remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def cleanup_stale():
+    """يحذف الملفات المؤقتة المتبقية من تشغيل سابق."""
+    cutoff = time.time() - STALE_AFTER
+    for path in glob.glob(os.path.join(TRANSCODE_DIR, "clipbot-*")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+async def run_ffmpeg(args: list[str], priority: int = 0, duration: float | None = None,
+                     on_progress=None):
+    """يشغل ffmpeg كعملية منفصلة عبر طابور المهام.
+
+    إذا أُعطيت ``duration`` و ``on_progress`` تُستدعى ``on_progress(percent)``
+    مع تقدم التحويل (من مخرجات ``-progress``).
+    """
+    async with jobs.slot(priority):
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-hide_banner", "-loglevel", "error", "-nostats",
+                "-progress", "pipe:1", "-y", *args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            raise TranscodeError("ffmpeg is not installed")
+
+        stderr_task = asyncio.create_task(process.stderr.read())
+        try:
+            async for line in process.stdout:
+                key, _, value = line.decode(errors="ignore").strip().partition("=")
+                if key == "out_time_us" and duration and on_progress and value.isdigit():
+                    await on_progress(min(99, int(int(value) / 1e6 / duration * 100)))
+            await process.wait()
+            stderr = await stderr_task
+        finally:
+            # إلغاء أو خطأ في on_progress: لا نترك ffmpeg يعمل بعد تحرير المكان في الطابور
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            stderr_task.cancel()
+
+        if process.returncode != 0:
+            raise TranscodeError(stderr.decode(errors="ignore")[-500:])
+
+def input_args(source_url: str, headers: dict | None = None) -> list[str]:
+    """``-i`` للمصدر، مع ترويسات HTTP التي يطلبها خادمه إن وجدت."""
+    if not headers:
+        return ["-i", source_url]
+    return ["-headers", "".join(f"{name}: {value}\r\n" for name, value in headers.items()), "-i", source_url]
+
+@asynccontextmanager
+async def audio_file(source_url: str, acodec: str | None, priority: int = 0,
+                     headers: dict | None = None):
+    """يستخرج الصوت إلى ملف مؤقت يُحذف عند الخروج.
+
+    AAC يُنسخ كما هو إلى m4a (بدون إعادة ترميز)، وغيره يُحول إلى mp3.
+    """
+    copy = (acodec or "").startswith("mp4a")
+    path = temp_path("m4a" if copy else "mp3")
+    codec = ["-c:a", "copy"] if copy else ["-c:a", "libmp3lame", "-q:a", "2"]
+    try:
+        await run_ffmpeg([*input_args(source_url, headers), "-vn", *codec, path], priority=priority)
+        yield path
+    finally:
+        remove_quietly(path)
+
+def video_args(source_url: str, path: str, duration: float | None, size_cap: int,
+               max_height: int | None, filesize: int | None, vcodec: str | None,
+               acodec: str | None, headers: dict | None = None,
+               height: int | None = None) -> list[str]:
+    """نسخ الحاوية فقط إذا كان الملف ضمن الحد والدقة وبترميز H.264/AAC، وإلا إعادة ترميز بمعدل بت يناسب الحد."""
+    if filesize and filesize <= size_cap and (vcodec or "").startswith("avc1") \
+            and (acodec or "").startswith("mp4a") and not (max_height and (height or 0) > max_height):
+        return [*input_args(source_url, headers), "-c", "copy", "-movflags", "+faststart", path]
+
+    if not duration:
+        raise TranscodeError("unknown duration, cannot size the output")
+
+    # 5% هامش لرؤوس الحاوية
+    total_kbps = size_cap * 8 * 0.95 / duration / 1000
+    video_kbps = int(total_kbps - AUDIO_BITRATE_KBPS)
+    if video_kbps < 100:
+        raise TranscodeError("video too long to fit the size limit")
+
+    height = next(h for min_kbps, h in HEIGHT_FOR_BITRATE if video_kbps >= min_kbps)
+    if max_height:
+        height = min(height, max_height)
+
+    return [
+        *input_args(source_url, headers),
+        "-vf", f"scale=-2:'min({height},ih)'",
+        "-c:v", "libx264", "-preset", "veryfast", "-threads", str(FFMPEG_THREADS),
+        "-b:v", f"{video_kbps}k", "-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k",
+        "-c:a", "aac", "-b:a", f"{AUDIO_BITRATE_KBPS}k",
+        "-movflags", "+faststart",
+        path,
+    ]
+
+@asynccontextmanager
+async def fit_video(source_url: str, duration: float | None, size_cap: int,
+                    max_height: int | None = None, filesize: int | None = None,
+                    vcodec: str | None = None, acodec: str | None = None,
+                    priority: int = 0, on_progress=None, headers: dict | None = None,
+                    height: int | None = None):
+    """يحول الفيديو إلى MP4 ضمن ``size_cap`` في ملف مؤقت يُحذف عند الخروج."""
+    path = temp_path("mp4")
+    try:
+        args = video_args(source_url, path, duration, size_cap, max_height, filesize, vcodec, acodec,
+                          headers, height)
+        await run_ffmpeg(args, priority=priority, duration=duration, on_progress=on_progress)
+        if os.path.getsize(path) > size_cap:
+            raise TranscodeError("output is still over the size limit")
+        yield path
+    finally:
+        remove_quietly(path)
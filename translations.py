@@ -124,7 +124,7 @@ TRANSLATIONS = {
         
         # Errors
         'error_invalid_url': '❌ الرجاء إرسال رابط صحيح من يوتيوب، تيك توك، أو انستقرام.',
-        'error_limit_reached': '⚠️ لقد وصلت إلى الحد اليومي ({limit} تنزيل).\n\nيمكنك الترقية لاشتراك أعلى للحصول على المزيد!\n/subscribe',
+        'error_limit_reached': '⚠️ لقد وصلت إلى الحد اليومي ({limit} تنزيل).\n\nيتجدد الحد منتصف الليل بتوقيت UTC.',
         'error_no_url': '❌ لم يتم العثور على رابط صحيح.',
         'error_download_failed': '❌ {error}',
         'error_admin_only': '❌ هذا الأمر متاح للمسؤولين فقط.',
@@ -282,7 +282,7 @@ Need help? Contact support! 💬
         
         # Errors
         'error_invalid_url': '❌ Please send a valid link from YouTube, TikTok, or Instagram.',
-        'error_limit_reached': '⚠️ You have reached your daily limit ({limit} downloads).\n\nYou can upgrade to a higher subscription for more!\n/subscribe',
+        'error_limit_reached': '⚠️ You have reached your daily limit ({limit} downloads).\n\nThe limit resets at midnight UTC.',
         'error_no_url': '❌ No valid link found.',
         'error_download_failed': '❌ {error}',
         'error_admin_only': '❌ This command is available for admins only.',